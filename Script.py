@@ -1,4 +1,5 @@
 #!/usr/bin/env python
+from dataset import read_csv
 from tqdm import tqdm
 import pandas as pd
 import numpy as np
@@ -9,14 +10,19 @@ parser.add_argument('--mode', '-m', type = int, default = 0, help = 'Mode for tr
 parser.add_argument('--dataset', '-d',  type = str, default = 'mimic', help = 'Dataset to use: mimic, eicu, ')
 parser.add_argument('--sub', '-s', action='store_true', help = 'Run on subset of vitals.')
 parser.add_argument('--over', '-o', action='store_true', help = 'Oversample smaller set.')
+parser.add_argument('--jobs', '-j', type = int, default = 1, help = 'Number of hyperparameters fitted in parallel.')
+parser.add_argument('--prune', '-p', action='store_true', help = 'Stop clearly losing hyperparameters early (successive halving).')
+parser.add_argument('--bank', '-b', action='store_true', help = 'Fit deepsurv hyperparameters differing only by learning rate in lockstep (same models as without, cannot be combined with --prune).')
 args = parser.parse_args()
+if args.bank and args.prune:
+    parser.error('--bank cannot be combined with --prune (rungs would be reported out of the grid order)')
 
 
 
 # This number is used only for training, the testing happens only on the first 24 hours to ensure that
 # each patient has the same impact on the final performance computation
-labs = pd.read_csv('data/{}/labs_first_day_subselection.csv'.format(args.dataset), index_col = [0, 1]) if args.sub else pd.read_csv('data/{}/labs_first_day.csv'.format(args.dataset), index_col = [0, 1], header = [0, 1])
-outcomes = pd.read_csv('data/{}/outcomes_first_day{}.csv'.format(args.dataset, '_subselection' if args.sub else ''), index_col = 0)
+labs = read_csv('data/{}/labs_first_day_subselection.csv'.format(args.dataset), index_col = [0, 1]) if args.sub else read_csv('data/{}/labs_first_day.csv'.format(args.dataset), index_col = [0, 1], header = [0, 1])
+outcomes = read_csv('data/{}/outcomes_first_day{}.csv'.format(args.dataset, '_subselection' if args.sub else ''), index_col = 0)
 
 if args.dataset == 'mimic':
     outcomes['Death'] = ~outcomes.Death.isna()
@@ -64,54 +70,65 @@ print('Total patients: {}'.format(len(training)))
 print('Training patients: {}'.format(training.sum()))
 
 from experiment import ShiftExperiment
-def process(data, labels):
-    """
-        Extracts mask and interevents
-        Preprocesses the time of event and event
-    """
-    cov = data.copy().astype(float)
-    cov = cov.groupby('Patient').ffill() 
-    
-    patient_mean = data.astype(float).groupby('Patient').mean()
-    cov.fillna(patient_mean, inplace=True) 
+from preprocessing import process
+import preprocessing
+from dataset import FeatureStore, hash_data, hash_source
+
+# Successive halving with default rungs
+pruning = {} if args.prune else None
 
-    pop_mean = patient_mean.mean()
-    cov.fillna(pop_mean, inplace=True) 
+# Derived features are computed once for the dataset (and saved for following runs)
+store = FeatureStore('data/{}/features{}'.format(args.dataset, '_subselection' if args.sub else ''))
+dataset = hash_data(labs, outcomes)
 
-    ie_time = data.groupby("Patient").apply(lambda x: x.index.get_level_values('Time').to_series().diff().fillna(0))
-    mask = ~data.isna() 
-    time_event = pd.DataFrame((labels.LOS.loc[data.index.get_level_values(0)] - data.index.get_level_values(1)).values, index = data.index)
+def with_mask(data):
+    return pd.concat([data, data.isna().add_suffix('_mask').astype(float)], axis = 1)
 
-    return cov, ie_time, mask, time_event, labels.Death
+def with_time(data):
+    data = data.copy()
+    data['Time'] = data.index.to_frame().reset_index(drop = True).groupby('Patient').diff().fillna(0).values
+    return data
 
+def resample(data):
+    data = data.set_index(pd.to_datetime(data.index.get_level_values('Time'), unit = 'D'), append = True) 
+    data = data.groupby('Patient').resample('1H', level = 2).mean() 
+    data.index = data.index.map(lambda x: (x[0], x[1].hour / 24))
+    return data
 
+def features(name, transform = lambda data: data):
+    """
+        Processed transformation of the labs - See process
+        (Recomputed if the transformations or the preprocessing change)
+    """
+    return store.get(name, lambda: process(transform(labs), outcomes), dataset,
+        hash_source(transform, with_mask, with_time, resample, preprocessing))
 layers = [[], [50], [50, 50], [50, 50, 50]]
 
 # LOCF
-last = labs.groupby('Patient').ffill().groupby('Patient').last().fillna(labs.groupby('Patient').mean().mean()) 
+last = store.get('locf', lambda: labs.groupby('Patient').ffill().groupby('Patient').last().fillna(labs.groupby('Patient').mean().mean()), dataset)
 
 se = ShiftExperiment.create(model = 'deepsurv', 
                     hyper_grid = {"survival_args": [{"layers": l} for l in layers],
                         "lr" : [1e-3, 1e-4],
                         "batch": [100, 250]
                     }, 
-                    path = results + 'deepsurv_last')
+                    path = results + 'deepsurv_last', pruning = pruning)
 
 
-se.train(last, outcomes.Remaining, outcomes.Death, training, oversampling_ratio = ratio)
+se.train(last, outcomes.Remaining, outcomes.Death, training, oversampling_ratio = ratio, n_jobs = args.jobs, bank = args.bank)
 
 # Count
-count = (~labs.isna()).groupby('Patient').sum() # Compute counts
+count = store.get('count', lambda: (~labs.isna()).groupby('Patient').sum(), dataset) # Compute counts
 
 se = ShiftExperiment.create(model = 'deepsurv', 
                     hyper_grid = {"survival_args": [{"layers": l} for l in layers],
                         "lr" : [1e-3, 1e-4],
                         "batch": [100, 250]
                     }, 
-                    path = results + 'deepsurv_count')
+                    path = results + 'deepsurv_count', pruning = pruning)
 
 
-se.train(pd.concat([last, count], axis = 1), outcomes.Remaining, outcomes.Death, training, oversampling_ratio = ratio)
+se.train(pd.concat([last, count], axis = 1), outcomes.Remaining, outcomes.Death, training, oversampling_ratio = ratio, n_jobs = args.jobs, bank = args.bank)
 
 hyper_grid = {
         "layers": [1, 2, 3],
@@ -123,55 +140,47 @@ hyper_grid = {
     }
 
 # LSTM with value
-cov, ie, mask, time, event = process(labs.copy(), outcomes)
+cov, ie, mask, time, event = features('value')
 
 se = ShiftExperiment.create(model = 'joint', 
                     hyper_grid = hyper_grid,
-                    path = results + 'lstm_value')
+                    path = results + 'lstm_value', pruning = pruning)
 
 
-se.train(cov, time, event, training, ie, mask, oversampling_ratio = ratio)
+se.train(cov, time, event, training, ie, mask, oversampling_ratio = ratio, n_jobs = args.jobs)
 
 # LSTM with input
-labs_selection = pd.concat([labs.copy(), labs.isna().add_suffix('_mask').astype(float)], axis = 1)
-labs_selection['Time'] = labs_selection.index.to_frame().reset_index(drop = True).groupby('Patient').diff().fillna(0).values
-cov, ie, mask, time, event = process(labs_selection, outcomes)
+cov, ie, mask, time, event = features('value+time+mask', lambda data: with_time(with_mask(data)))
 
 
 se = ShiftExperiment.create(model = 'joint', 
                     hyper_grid = hyper_grid,
-                    path = results + 'lstm_value+time+mask')
+                    path = results + 'lstm_value+time+mask', pruning = pruning)
 
 
-se.train(cov, time, event, training, ie, mask, oversampling_ratio = ratio)
+se.train(cov, time, event, training, ie, mask, oversampling_ratio = ratio, n_jobs = args.jobs)
 
 # Resampling
-labs_resample = labs.copy()
-labs_resample = labs_resample.set_index(pd.to_datetime(labs_resample.index.get_level_values('Time'), unit = 'D'), append = True) 
-labs_resample = labs_resample.groupby('Patient').resample('1H', level = 2).mean() 
-labs_resample.index = labs_resample.index.map(lambda x: (x[0], x[1].hour / 24))
-
-cov, ie, mask, time, event = process(labs_resample, outcomes) 
+cov, ie, mask, time, event = features('resampled', resample)
 
 se = ShiftExperiment.create(model = 'joint', 
                     hyper_grid = hyper_grid,
-                    path = results + 'lstm+resampled')
+                    path = results + 'lstm+resampled', pruning = pruning)
 
 
-se.train(cov, time, event, training, ie, mask, oversampling_ratio = ratio)
+se.train(cov, time, event, training, ie, mask, oversampling_ratio = ratio, n_jobs = args.jobs)
 
 # GRUD
 hyper_grid_gru = hyper_grid.copy()
 hyper_grid_gru["typ"] = ['GRUD']
 
-labs_selection = pd.concat([labs.copy(), labs.isna().add_suffix('_mask').astype(float)], axis = 1)
-cov, ie, mask, time, event = process(labs_selection, outcomes)
+cov, ie, mask, time, event = features('value+mask', with_mask)
 
 se = ShiftExperiment.create(model = 'joint', 
                     hyper_grid = hyper_grid_gru,
-                    path = results + 'gru_d+mask')
+                    path = results + 'gru_d+mask', pruning = pruning)
 
-se.train(cov, time, event, training, ie, mask, oversampling_ratio = ratio)
+se.train(cov, time, event, training, ie, mask, oversampling_ratio = ratio, n_jobs = args.jobs)
 
 hyper_grid_joint = hyper_grid.copy()
 hyper_grid_joint.update(
@@ -187,33 +196,29 @@ hyper_grid_joint.update(
 )
 
 # Joint full
-labs_selection = labs.copy()
-cov, ie, mask, time, event = process(labs_selection, outcomes)
+cov, ie, mask, time, event = features('value')
 
 se = ShiftExperiment.create(model = 'joint', 
                     hyper_grid = hyper_grid_joint,
-                    path = results + 'joint+value')
+                    path = results + 'joint+value', pruning = pruning)
 
 
-se.train(cov, time, event, training, ie, mask, oversampling_ratio = ratio)
+se.train(cov, time, event, training, ie, mask, oversampling_ratio = ratio, n_jobs = args.jobs)
 
 # Joint GRU-D
 hyper_grid_joint_gru = hyper_grid_joint.copy()
 hyper_grid_joint_gru["typ"] = ['GRUD']
 
-labs_selection = pd.concat([labs.copy(), labs.isna().add_suffix('_mask').astype(float)], axis = 1)
-cov, ie, mask, time, event = process(labs_selection, outcomes)
+cov, ie, mask, time, event = features('value+mask', with_mask)
 
 se = ShiftExperiment.create(model = 'joint', 
                     hyper_grid = hyper_grid_joint_gru,
-                    path = results + 'joint_gru_d+mask')
+                    path = results + 'joint_gru_d+mask', pruning = pruning)
 
-se.train(cov, time, event, training, ie, mask, oversampling_ratio = ratio)
+se.train(cov, time, event, training, ie, mask, oversampling_ratio = ratio, n_jobs = args.jobs)
 
 # Joint with full input
-labs_selection = pd.concat([labs.copy(), labs.isna().add_suffix('_mask').astype(float)], 1)
-labs_selection['Time'] = labs_selection.index.to_frame().reset_index(drop = True).groupby('Patient').diff().fillna(0).values
-cov, ie, mask, time, event = process(labs_selection, outcomes)
+cov, ie, mask, time, event = features('value+time+mask', lambda data: with_time(with_mask(data)))
 
 mask_mixture = np.full(len(cov.columns), False)
 mask_mixture[:len(labs.columns)] = True
@@ -222,15 +227,13 @@ hyper_grid_joint['mixture_mask'] = [mask_mixture]
 
 se = ShiftExperiment.create(model = 'joint', 
                     hyper_grid = hyper_grid_joint,
-                    path = results + 'joint_value+time+mask')
+                    path = results + 'joint_value+time+mask', pruning = pruning)
 
 
-se.train(cov, time, event, training, ie, mask, oversampling_ratio = ratio)
+se.train(cov, time, event, training, ie, mask, oversampling_ratio = ratio, n_jobs = args.jobs)
 
 # Joint GRU-D with full input
-labs_selection = pd.concat([labs.copy(), labs.isna().add_suffix('_mask').astype(float)], 1)
-labs_selection['Time'] = labs_selection.index.to_frame().reset_index(drop = True).groupby('Patient').diff().fillna(0).values
-cov, ie, mask, time, event = process(labs_selection, outcomes)
+cov, ie, mask, time, event = features('value+time+mask', lambda data: with_time(with_mask(data)))
 
 mask_mixture = np.full(len(cov.columns), False)
 mask_mixture[:len(labs.columns)] = True
@@ -239,20 +242,20 @@ hyper_grid_joint_gru['mixture_mask'] = [mask_mixture]
 
 se = ShiftExperiment.create(model = 'joint', 
                     hyper_grid = hyper_grid_joint_gru,
-                    path = results + 'joint_gru_d_value+time+mask')
+                    path = results + 'joint_gru_d_value+time+mask', pruning = pruning)
 
 
-se.train(cov, time, event, training, ie, mask, oversampling_ratio = ratio)
+se.train(cov, time, event, training, ie, mask, oversampling_ratio = ratio, n_jobs = args.jobs)
 
 # Full Fine Tune
 hyper_grid_joint['full_finetune'] = [True] 
 
 se = ShiftExperiment.create(model = 'joint', 
                     hyper_grid = hyper_grid_joint,
-                    path = results + 'joint_full_finetune_value+time+mask')
+                    path = results + 'joint_full_finetune_value+time+mask', pruning = pruning)
 
 
-se.train(cov, time, event, training, ie, mask, oversampling_ratio = ratio)
+se.train(cov, time, event, training, ie, mask, oversampling_ratio = ratio, n_jobs = args.jobs)
 
 
 # ##################
@@ -260,8 +263,7 @@ se.train(cov, time, event, training, ie, mask, oversampling_ratio = ratio)
 # ##################
 
 # Measure impact of modelling the outcome with same input
-labs_selection = labs.copy()
-cov, ie, mask, time, event = process(labs_selection, outcomes)
+cov, ie, mask, time, event = features('value')
 
 hyper_grid_joint = hyper_grid.copy() #L
 hyper_grid_joint.update(
@@ -274,10 +276,10 @@ hyper_grid_joint.update(
 
 se = ShiftExperiment.create(model = 'joint', 
                     hyper_grid = hyper_grid_joint,
-                    path = results + 'joint+value-long')
+                    path = results + 'joint+value-long', pruning = pruning)
 
 
-se.train(cov, time, event, training, ie, mask, oversampling_ratio = ratio)
+se.train(cov, time, event, training, ie, mask, oversampling_ratio = ratio, n_jobs = args.jobs)
 
 
 hyper_grid_joint = hyper_grid.copy()
@@ -290,10 +292,10 @@ hyper_grid_joint.update(
 )
 se = ShiftExperiment.create(model = 'joint', 
                     hyper_grid = hyper_grid_joint,
-                    path = results + 'joint+value-time')
+                    path = results + 'joint+value-time', pruning = pruning)
 
 
-se.train(cov, time, event, training, ie, mask, oversampling_ratio = ratio)
+se.train(cov, time, event, training, ie, mask, oversampling_ratio = ratio, n_jobs = args.jobs)
 
 
 hyper_grid_joint = hyper_grid.copy()
@@ -307,10 +309,10 @@ hyper_grid_joint.update(
 
 se = ShiftExperiment.create(model = 'joint', 
                     hyper_grid = hyper_grid_joint,
-                    path = results + 'joint+value-missing')
+                    path = results + 'joint+value-missing', pruning = pruning)
 
 
-se.train(cov, time, event, training, ie, mask, oversampling_ratio = ratio)
+se.train(cov, time, event, training, ie, mask, oversampling_ratio = ratio, n_jobs = args.jobs)
 
 hyper_grid_joint = hyper_grid.copy()
 hyper_grid_joint.update(
@@ -325,10 +327,10 @@ hyper_grid_joint.update(
 
 se = ShiftExperiment.create(model = 'joint', 
                     hyper_grid = hyper_grid_joint,
-                    path = results + 'joint+value-long-time')
+                    path = results + 'joint+value-long-time', pruning = pruning)
 
 
-se.train(cov, time, event, training, ie, mask, oversampling_ratio = ratio)
+se.train(cov, time, event, training, ie, mask, oversampling_ratio = ratio, n_jobs = args.jobs)
 
 hyper_grid_joint = hyper_grid.copy()
 hyper_grid_joint.update(
@@ -343,10 +345,10 @@ hyper_grid_joint.update(
 
 se = ShiftExperiment.create(model = 'joint', 
                     hyper_grid = hyper_grid_joint,
-                    path = results + 'joint+value-long-missing')
+                    path = results + 'joint+value-long-missing', pruning = pruning)
 
 
-se.train(cov, time, event, training, ie, mask, oversampling_ratio = ratio)
+se.train(cov, time, event, training, ie, mask, oversampling_ratio = ratio, n_jobs = args.jobs)
 
 hyper_grid_joint = hyper_grid.copy()
 hyper_grid_joint.update(
@@ -359,15 +361,14 @@ hyper_grid_joint.update(
     }
 )
 # Joint temporal output only
-labs_selection = labs.copy()
-cov, ie, mask, time, event = process(labs_selection, outcomes)
+cov, ie, mask, time, event = features('value')
 
 se = ShiftExperiment.create(model = 'joint', 
                     hyper_grid = hyper_grid_joint,
-                    path = results + 'joint+value-time-missing')
+                    path = results + 'joint+value-time-missing', pruning = pruning)
 
 
-se.train(cov, time, event, training, ie, mask, oversampling_ratio = ratio)
+se.train(cov, time, event, training, ie, mask, oversampling_ratio = ratio, n_jobs = args.jobs)
 
 
 # Impact of input
@@ -384,9 +385,7 @@ hyper_grid_joint.update(
     }
 )
 # Joint with value + time only
-labs_selection = labs.copy()
-labs_selection['Time'] = labs_selection.index.to_frame().reset_index(drop = True).groupby('Patient').diff().fillna(0).values
-cov, ie, mask, time, event = process(labs_selection, outcomes)
+cov, ie, mask, time, event = features('value+time', with_time)
 
 mask_mixture = np.full(len(cov.columns), False)
 mask_mixture[:len(labs.columns)] = True
@@ -395,13 +394,12 @@ hyper_grid_joint['mixture_mask'] = [mask_mixture]
 
 se = ShiftExperiment.create(model = 'joint', 
                     hyper_grid = hyper_grid_joint,
-                    path = results + 'joint_value+time')
+                    path = results + 'joint_value+time', pruning = pruning)
 
-se.train(cov, time, event, training, ie, mask, oversampling_ratio = ratio)
+se.train(cov, time, event, training, ie, mask, oversampling_ratio = ratio, n_jobs = args.jobs)
 
 # Joint with value + mask only
-labs_selection = pd.concat([labs.copy(), labs.isna().add_suffix('_mask').astype(float)], 1)
-cov, ie, mask, time, event = process(labs_selection, outcomes)
+cov, ie, mask, time, event = features('value+mask', with_mask)
 
 mask_mixture = np.full(len(cov.columns), False)
 mask_mixture[:len(labs.columns)] = True
@@ -410,7 +408,7 @@ hyper_grid_joint['mixture_mask'] = [mask_mixture]
 
 se = ShiftExperiment.create(model = 'joint', 
                     hyper_grid = hyper_grid_joint,
-                    path = results + 'joint_value+mask')
+                    path = results + 'joint_value+mask', pruning = pruning)
 
-se.train(cov, time, event, training, ie, mask, oversampling_ratio = ratio)
+se.train(cov, time, event, training, ie, mask, oversampling_ratio = ratio, n_jobs = args.jobs)
 
@@ -0,0 +1,639 @@
+#!/usr/bin/env python
+from time import perf_counter
+import tracemalloc
+import os
+import pandas as pd
+import numpy as np
+
+import argparse
+parser = argparse.ArgumentParser(description = 'Running benchmarks.')
+parser.add_argument('--bench', '-b', type = str, default = 'split', help = 'Benchmark to run: split, pad, bucket, dtype, pruning, bank, snapshot, loader, cox, baseline, horizon, grud, ode, point, heads, mixture.')
+parser.add_argument('--seed', type = int, default = 0, help = 'Random seed for the synthetic cohort.')
+args = parser.parse_args()
+
+def synthetic(patients, d = 10, mean_length = 10, seed = 0):
+    """
+        Generates a multi index (Patient, Time) dataframe similar to labs_first_day
+        (Skewed number of observations per patient)
+    """
+    rng = np.random.default_rng(seed)
+    lengths = rng.geometric(1 / mean_length, size = patients)
+    patient = np.repeat(np.arange(patients), lengths)
+    time = rng.uniform(0, 1, size = len(patient))
+    index = pd.MultiIndex.from_arrays([patient, time], names = ['Patient', 'Time'])
+    return pd.DataFrame(rng.normal(size = (len(patient), d)), index = index).sort_index()
+
+def peak_memory(func, *args):
+    tracemalloc.start()
+    func(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 2**20
+
+def graph_memory(func, *args):
+    # Memory kept by autograd for backward (tensors saved by the graph - tracemalloc does not see torch)
+    import torch
+    size = []
+    def pack(tensor):
+        size.append(tensor.numel() * tensor.element_size())
+        return tensor
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        func(*args)
+    return sum(size) / 2**20
+
+def timeit(func, *args, repeat = 3):
+    best = np.inf
+    for _ in range(repeat):
+        start = perf_counter()
+        func(*args)
+        best = min(best, perf_counter() - start)
+    return best
+
+def split_legacy(x):
+    # Previous pandas_to_list: one full scan of the index per patient
+    result = []
+    for patient in x.index.unique(level = 0):
+        selection = x.index.get_level_values(0) == patient
+        result.append(x[selection].values)
+    return result
+
+def bench_split():
+    from models.utils import pandas_to_offsets, pandas_to_list
+    print('{:>10} {:>10} {:>12} {:>12} {:>12}'.format('Patients', 'Rows', 'Legacy (s)', 'Offsets (s)', 'List (s)'))
+    for patients in [1000, 5000, 20000, 50000, 200000]:
+        x = synthetic(patients, seed = args.seed)
+        legacy = timeit(split_legacy, x, repeat = 1) if patients <= 20000 else np.nan # Quadratic: too slow on large cohorts
+        print('{:>10} {:>10} {:>12.4f} {:>12.4f} {:>12.4f}'.format(patients, len(x), legacy,
+            timeit(pandas_to_offsets, x), timeit(pandas_to_list, x)))
+
+def pad_legacy(x):
+    # Previous RNNJoint.preprocess: padded copy per patient then stacked
+    from models.utils import pandas_to_list
+    x = pandas_to_list(x)
+    l = [len(xi) for xi in x]
+    max_length = max(l)
+    xres = [np.concatenate([xi, np.zeros(shape = (max_length - li, xi.shape[1]))]) for xi, li in zip(x, l)]
+    return np.array(xres, dtype = float)
+
+def bench_pad():
+    from models.utils import pandas_to_offsets, offsets_to_padded
+    def pad(x):
+        return offsets_to_padded(*pandas_to_offsets(x))
+
+    print('{:>10} {:>12} {:>12} {:>12} {:>12} {:>12}'.format('Patients', 'Padded (MB)', 'Legacy (s)', 'Legacy (MB)', 'Single (s)', 'Single (MB)'))
+    for patients in [1000, 5000, 20000, 50000]:
+        x = synthetic(patients, mean_length = 5, seed = args.seed)
+        padded = pad(x)
+        print('{:>10} {:>12.1f} {:>12.4f} {:>12.1f} {:>12.4f} {:>12.1f}'.format(patients, padded.nbytes / 2**20,
+            timeit(pad_legacy, x, repeat = 1), peak_memory(pad_legacy, x),
+            timeit(pad, x), peak_memory(pad, x)))
+
+def synthetic_joint(patients, d = 10, mean_length = 10, seed = 0, signal = 0.):
+    """
+        Generates covariates, interevent, mask, event and time for the joint model
+        (signal: effect of the patient's mean first covariate on the length of stay)
+    """
+    rng = np.random.default_rng(seed)
+    x = synthetic(patients, d, mean_length, seed)
+    times = x.index.get_level_values('Time').to_series(index = x.index)
+    ie = times.groupby('Patient').diff().fillna(0)
+    mask = pd.DataFrame(rng.uniform(size = x.shape) > 0.5, index = x.index)
+    risk = signal * x[0].groupby('Patient').mean().values
+    los = pd.Series(1 + rng.exponential(7, size = patients) * np.exp(- risk))
+    t = pd.DataFrame(los.loc[x.index.get_level_values(0)].values - x.index.get_level_values(1), index = x.index)
+    e = pd.Series(rng.uniform(size = patients) > 0.8).astype(int)
+    return x, ie, mask, e, t
+
+def bench_bucket():
+    import torch
+    from models.rnn_joint import RNNJoint, train_torch_model
+    from models.utils import length_batches
+
+    def padding(l, batches, global_max):
+        # Ratio of padded cells in the batches
+        used = sum(len(b) * (l[b].max() if global_max is None else global_max) for b in batches)
+        return 1 - l.sum() / used
+
+    x, i, m, e, t = synthetic_joint(20000, seed = args.seed)
+    data = RNNJoint.to_tensors(x, i, m, e, t)
+    l = data[4].numpy()
+    batch, epochs = 250, 2
+    print('Patients: {} - Mean length: {:.1f} - Max length: {}'.format(len(l), l.mean(), l.max()))
+    print('{:>8} {:>10} {:>12} {:>15}'.format('Typ', 'Bucket', 'Padding', 'Epoch time (s)'))
+    for typ in ['LSTM', 'GRUD']:
+        for bucket in [0, 50]:
+            np.random.seed(args.seed)
+            torch.manual_seed(args.seed)
+            if bucket:
+                ratio = padding(l, length_batches(l, batch, bucket), None)
+            else:
+                ratio = padding(l, np.array_split(np.arange(len(l)), len(l) // batch), l.max())
+            model = RNNJoint(x.shape[1], 1, cuda = False, typ = typ)
+            start = perf_counter()
+            train_torch_model(model.model, *data, None, None, None, None, None, None,
+                epochs = 0, pretrain_ite = epochs, batch = batch, bucket = bucket)
+            print('{:>8} {:>10} {:>12.3f} {:>15.3f}'.format(typ, bucket, ratio, (perf_counter() - start) / epochs))
+
+def concordance(risk, t, e):
+    """
+        Harrell's C-index (pairs ordered by the observed event)
+    """
+    comparable = (t[:, None] < t[None, :]) & (e[:, None] == 1)
+    concordant = (risk[:, None] > risk[None, :]) + 0.5 * (risk[:, None] == risk[None, :])
+    return (concordant * comparable).sum() / comparable.sum()
+
+def bench_dtype(tolerance = 0.01):
+    import torch
+    from models.rnn_joint import RNNJoint
+
+    x, i, m, e, t = synthetic_joint(2000, d = 5, seed = args.seed, signal = 1.)
+    los = t.groupby(level = 0).first().iloc[:, 0].values
+    horizon, epochs = np.median(los), 5
+    print('{:>8} {:>10} {:>15} {:>10}'.format('Typ', 'Dtype', 'Epoch time (s)', 'C-index'))
+    for typ in ['LSTM', 'GRUD']:
+        cindex = {}
+        for dtype in [torch.float64, torch.float32]:
+            np.random.seed(args.seed)
+            torch.manual_seed(args.seed)
+            model = RNNJoint(x.shape[1], 1, cuda = False, typ = typ, dtype = dtype)
+            data = model.preprocess(x, i, m, e, t)
+            start = perf_counter()
+            model.fit(data, None, None, None, None, epochs = epochs, pretrain_ite = 0, lr = 0.001, batch = 250, patience = epochs)
+            duration = (perf_counter() - start) / epochs
+            cindex[dtype] = concordance(- model.predict(data, None, None, horizon = [horizon]).ravel(), los, e.values)
+            print('{:>8} {:>10} {:>15.3f} {:>10.4f}'.format(typ, str(dtype).replace('torch.', ''), duration, cindex[dtype]))
+        assert abs(cindex[torch.float64] - cindex[torch.float32]) < tolerance, \
+            'C-index differs by more than {} between float64 and float32'.format(tolerance)
+
+def bench_pruning():
+    import tempfile
+    from experiment import ShiftExperiment
+
+    x, i, m, e, t = synthetic_joint(5000, d = 5, seed = args.seed, signal = 1.)
+    last = x.groupby('Patient').last()
+    los = t.groupby(level = 0).first().iloc[:, 0]
+    training = pd.Series(np.ones(len(last), dtype = bool))
+    hyper_grid = {"survival_args": [{"layers": l} for l in [[], [50], [50, 50], [50, 50, 50]]],
+        "lr" : [1e-3, 1e-4],
+        "batch": [100, 250]
+    }
+    print('{:>10} {:>10} {:>10} {:>50}'.format('Pruning', 'Time (s)', 'Best NLL', 'Best hyperparameters'))
+    with tempfile.TemporaryDirectory() as directory:
+        for pruning in [None, {}]:
+            se = ShiftExperiment.create(model = 'deepsurv', hyper_grid = hyper_grid, random_seed = args.seed,
+                path = os.path.join(directory, str(pruning)), save = False, pruning = pruning, force = True)
+            start = perf_counter()
+            se.train(last, los, e, training)
+            print('{:>10} {:>10.1f} {:>10.4f} {:>50}'.format(str(pruning is not None), perf_counter() - start, se.best_nll, str(se.best_hyper)))
+
+def bench_bank():
+    import torch
+    from models.deepsurv import DeepSurv, train_torch_model, train_torch_bank
+
+    x, i, m, e, t = synthetic_joint(5000, d = 5, seed = args.seed, signal = 1.)
+    data = DeepSurv.to_tensors(x.groupby('Patient').last(), e, t.groupby(level = 0).first().iloc[:, 0])
+    epochs, batch = 5, 250
+    train_torch_model(DeepSurv(x.shape[1], 1, cuda = False).model, *data, None, None, None, epochs = 1, pretrain_ite = 0) # Warm up
+    print('{:>8} {:>12} {:>12} {:>25} {:>25}'.format('Members', 'Layers', 'Mode', 'Time (s)', 'Member epochs / s'))
+    for layers in [[50], [50, 50, 50]]:
+        for members in [2, 8, 32]:
+            lrs = list(np.logspace(-4, -2, members))
+            models = []
+            for _ in lrs:
+                torch.manual_seed(args.seed)
+                models.append(DeepSurv(x.shape[1], 1, cuda = False, survival_args = {'layers': layers}).model)
+
+            np.random.seed(args.seed)
+            start = perf_counter()
+            for model, lr in zip(models, lrs):
+                train_torch_model(model, *data, None, None, None, epochs = epochs, pretrain_ite = 0, lr = lr, batch = batch)
+            duration = perf_counter() - start
+            print('{:>8} {:>12} {:>12} {:>25.3f} {:>25.1f}'.format(members, str(layers), 'Sequential', duration, members * epochs / duration))
+
+            np.random.seed(args.seed)
+            start = perf_counter()
+            train_torch_bank(models, *data, None, None, None, epochs = epochs, pretrain_ite = 0, lr = lrs, batch = batch)
+            duration = perf_counter() - start
+            print('{:>8} {:>12} {:>12} {:>25.3f} {:>25.1f}'.format(members, str(layers), 'Bank', duration, members * epochs / duration))
+
+def bench_snapshot(snapshots = 1000):
+    import torch
+    from copy import deepcopy
+    from models.rnn_joint import RNNJoint
+    from models.utils import WeightSnapshot
+
+    def copies(model):
+        for _ in range(snapshots):
+            best = deepcopy(model.state_dict())
+
+    def in_place(model):
+        best = WeightSnapshot(model)
+        for _ in range(snapshots):
+            best.take()
+
+    print('{:>8} {:>8} {:>12} {:>15} {:>15}'.format('Typ', 'Hidden', 'Parameters', 'Deepcopy (ms)', 'In place (ms)'))
+    for typ in ['LSTM', 'GRUD']:
+        for hidden in [10, 30, 100]:
+            model = RNNJoint(10, 1, cuda = False, typ = typ, hidden = hidden).model
+            parameters = sum(p.numel() for p in model.parameters())
+            print('{:>8} {:>8} {:>12} {:>15.3f} {:>15.3f}'.format(typ, hidden, parameters,
+                1000 * timeit(copies, model) / snapshots, 1000 * timeit(in_place, model) / snapshots))
+
+def bench_loader():
+    import torch
+    from models.rnn_joint import RNNJoint
+    from models.utils import BatchLoader
+
+    x, i, m, e, t = synthetic_joint(5000, seed = args.seed)
+    x, i, m, e, l, t = RNNJoint.to_tensors(x, i, m, e, t)
+    loader = BatchLoader([x, i, m, t, e, l])
+    synchronous = BatchLoader([x, i, m, t, e, l], prefetch = 0)
+
+    def legacy(batches, model = None, optimizer = None):
+        # Previous loop: six gathers on the main thread
+        for order in batches:
+            xb, ib, mb, tb, eb, lb = x[order], i[order], m[order], t[order], e[order], l[order]
+            if model is not None:
+                step(model, optimizer, xb, ib, mb, eb, lb, tb)
+
+    def prefetched(batches, model = None, optimizer = None, loader = loader):
+        for xb, ib, mb, tb, eb, lb in loader.iterate(batches):
+            if model is not None:
+                step(model, optimizer, xb, ib, mb, eb, lb, tb)
+
+    def step(model, optimizer, xb, ib, mb, eb, lb, tb):
+        optimizer.zero_grad()
+        loss, _ = model.loss(xb, ib, mb, eb, lb, tb)
+        loss.backward()
+        optimizer.step()
+
+    print('{:>8} {:>8} {:>20} {:>20} {:>20} {:>20} {:>20}'.format('Typ', 'Batch', 'Gather legacy (ms)', 'Gather fused (ms)', 'Step legacy (ms)', 'Step fused (ms)', 'Step prefetch (ms)'))
+    for typ in ['LSTM', 'GRUD']:
+        for batch in [100, 250]:
+            order = np.random.default_rng(args.seed).permutation(len(l))
+            batches = [order[j:j + batch] for j in range(0, len(order), batch)]
+            model = RNNJoint(x.shape[-1], 1, cuda = False, typ = typ).model
+            optimizer = torch.optim.Adam(model.parameters())
+            print('{:>8} {:>8} {:>20.3f} {:>20.3f} {:>20.3f} {:>20.3f} {:>20.3f}'.format(typ, batch,
+                1000 * timeit(legacy, batches) / len(batches), 1000 * timeit(prefetched, batches, None, None, synchronous) / len(batches),
+                1000 * timeit(legacy, batches, model, optimizer) / len(batches),
+                1000 * timeit(prefetched, batches, model, optimizer, synchronous) / len(batches),
+                1000 * timeit(prefetched, batches, model, optimizer) / len(batches)))
+
+def bench_cox(steps = 100):
+    import torch
+    from models.Survival.survival import DeepSurv
+
+    def legacy(model, h, e, t):
+        # Previous loss: batch sorted by decreasing time and one pass by risk
+        for _ in range(steps):
+            order = torch.argsort(t.squeeze(), descending = True)
+            predictions = model(h[order])[0].double()
+            p_cumsum, eo, loss = torch.logcumsumexp(predictions, 0), e[order].squeeze(), 0
+            for ei in range(1, model.outputdim + 1):
+                loss = loss - torch.sum(predictions[eo == ei][:, ei - 1]) + torch.sum(p_cumsum[eo == ei][:, ei - 1])
+            (loss / (eo != 0).sum()).backward()
+
+    def vectorized(model, h, e, t):
+        for _ in range(steps):
+            model.loss(h, e, t).backward()
+
+    print('{:>8} {:>8} {:>15} {:>15}'.format('Risks', 'Batch', 'Legacy (ms)', 'One pass (ms)'))
+    rng = np.random.default_rng(args.seed)
+    for risks in [1, 5, 20]:
+        for batch in [100, 1000]:
+            torch.manual_seed(args.seed)
+            model = DeepSurv(10, risks, {'layers': [50]}).double()
+            h = torch.tensor(rng.normal(size = (batch, 10)))
+            e = torch.tensor(rng.integers(0, risks + 1, size = (batch, 1)))
+            t = torch.tensor(rng.uniform(size = (batch, 1)))
+            print('{:>8} {:>8} {:>15.3f} {:>15.3f}'.format(risks, batch,
+                1000 * timeit(legacy, model, h, e, t) / steps, 1000 * timeit(vectorized, model, h, e, t) / steps))
+
+def bench_baseline():
+    import torch
+    from models.Survival.survival import DeepSurv
+
+    def legacy(model, h, e, t, weights):
+        # Previous estimator: two scans of the data by unique time
+        predictions = torch.exp(model(h)[0]) * weights.unsqueeze(1)
+        times, indices = torch.unique(t.squeeze(), return_inverse = True, sorted = True)
+        baselines = []
+        for risk in range(1, model.outputdim + 1):
+            e_summed, p_summed = [], []
+            for i, _ in enumerate(times):
+                e_summed.insert(0, ((e[indices == i] == risk).squeeze(-1) * weights[indices == i]).sum())
+                p_summed.insert(0, predictions[indices == i][:, risk - 1].sum())
+            e_summed, p_summed = torch.DoubleTensor(e_summed), torch.cumsum(torch.DoubleTensor(p_summed), 0)
+            baselines.append(torch.cumsum((e_summed / p_summed)[torch.arange(len(times), 0, -1) - 1], 0).unsqueeze(0))
+        return torch.cat(baselines, 0)
+
+    print('{:>8} {:>8} {:>15} {:>15} {:>20}'.format('Patients', 'Risks', 'Legacy (ms)', 'Scatter (ms)', 'Max difference'))
+    rng = np.random.default_rng(args.seed)
+    for risks in [1, 3]:
+        for patients in [1000, 5000, 50000]:
+            torch.manual_seed(args.seed)
+            model = DeepSurv(10, risks, {'layers': [50]}).double()
+            h = torch.tensor(rng.normal(size = (patients, 10)))
+            e = torch.tensor(rng.integers(0, risks + 1, size = (patients, 1)))
+            t = torch.tensor(rng.uniform(size = (patients, 1)).round(3)) # Ties
+            weights = torch.tensor(rng.integers(0, 3, size = patients)).double() # Bootstrap: some patients not sampled
+            duplicated = [tensor.repeat_interleave(weights.long(), 0) for tensor in (h, e, t)]
+            with torch.no_grad():
+                duration = timeit(model.compute_baseline, h, e, t, None, weights)
+                if patients > 5000:
+                    # Quadratic: too long
+                    print('{:>8} {:>8} {:>15} {:>15.3f} {:>20}'.format(patients, risks, '-', 1000 * duration, '-'))
+                    continue
+                # Reference: previous estimator on the duplicated data
+                baselines = legacy(model, *duplicated, torch.ones(len(duplicated[0]), dtype = torch.double))
+                print('{:>8} {:>8} {:>15.3f} {:>15.3f} {:>20.2e}'.format(patients, risks, 1000 * timeit(legacy, model, *duplicated, torch.ones(len(duplicated[0]), dtype = torch.double), repeat = 1),
+                    1000 * duration, (baselines - model.baselines).abs().max().item()))
+
+def bench_horizon(horizon = [1, 7, 14, 30]):
+    import torch
+    from models.Survival.survival import DeepSurv
+
+    def legacy(model, h):
+        # Previous prediction: whole survival curves (n * T) by batch of 50, then one scan of the times by horizon
+        result = []
+        for j in range(0, len(h), 50):
+            forward = model.forward_batch(h[j:j + 50])[0]
+            curves = torch.exp(- torch.matmul(torch.exp(forward[:, :1]), model.baselines[:1]))
+            columns = []
+            for horizon_k in horizon:
+                _, closest = torch.min((model.times <= horizon_k), 0)
+                columns.append(torch.ones(len(curves), dtype = curves.dtype) if closest < 1 else curves[:, closest - 1])
+            result.append(torch.stack(columns).T)
+        return torch.cat(result)
+
+    def columns(model, h):
+        return model.predict(h, horizon = horizon)
+
+    print('{:>10} {:>10} {:>15} {:>15} {:>20}'.format('Times', 'Patients', 'Legacy (ms)', 'Horizons (ms)', 'Max difference'))
+    rng = np.random.default_rng(args.seed)
+    for times in [1000, 10000]:
+        torch.manual_seed(args.seed)
+        model = DeepSurv(10, 1, {'layers': [50]}).double()
+        with torch.no_grad():
+            model.compute_baseline(torch.tensor(rng.normal(size = (times, 10))), torch.tensor(rng.integers(0, 2, size = (times, 1))),
+                torch.tensor(rng.uniform(0, 20, size = (times, 1)))) # Last horizon after the last time
+            for patients in [1000, 10000]:
+                h = torch.tensor(rng.normal(size = (patients, 10)))
+                difference = (legacy(model, h) - columns(model, h))[:, :-1].abs().max().item()
+                print('{:>10} {:>10} {:>15.3f} {:>15.3f} {:>20.2e}'.format(times, patients,
+                    1000 * timeit(legacy, model, h), 1000 * timeit(columns, model, h), difference))
+
+def bench_grud(batch = 250):
+    import torch
+    from models.RNN.rnn import RNN
+    from models.rnn_joint import RNNJoint
+
+    def legacy_cell(cell, x, time, hidden):
+        # Previous cell: clamp tensors allocated at each step
+        decay = torch.exp(- torch.min(torch.max(torch.zeros(size = (cell.hidden_size,)), cell.decay(time)), torch.ones(size = (cell.hidden_size,)) * 1000))
+        hidden = hidden * decay
+        gi, gh = torch.mm(x, cell.weight_ih.t()) + cell.bias_ih, torch.mm(hidden, cell.weight_hh.t()) + cell.bias_hh
+        i_r, i_i, i_n = gi.chunk(3, 1)
+        h_r, h_i, h_n = gh.chunk(3, 1)
+        resetgate, inputgate = torch.sigmoid(i_r + h_r), torch.sigmoid(i_i + h_i)
+        newgate = torch.tanh(i_n + resetgate * h_n)
+        return newgate + inputgate * (hidden - newgate)
+
+    def legacy(model, x, t, m, l):
+        # Previous forward: outputs grown by cat at each step and last states gathered by patient
+        grud, hx, outputs = model.embedding, torch.zeros(x.size(0), model.hidden, dtype = x.dtype), None
+        for j in range(int(l.max())):
+            hx = legacy_cell(grud.cell, x[:, j], t[:, j:j+1], hx)
+            outputs = hx.unsqueeze(1) if outputs is None else torch.cat((outputs, hx.unsqueeze(1)), 1)
+        for j in range(int(l.max()), x.size(1)):
+            outputs = torch.cat((outputs, torch.zeros(x.size(0), 1, model.hidden, dtype = x.dtype)), 1)
+        end = outputs[0, l[0].long() - 1].unsqueeze(0)
+        for j in range(1, x.size(0)):
+            end = torch.cat((end, outputs[j, l[j].long() - 1].unsqueeze(0)), 0)
+        return end, outputs
+
+    def epoch(forward, model, data):
+        for j in range(0, len(data[0]), batch):
+            x, t, m, l = [d[j:j + batch] for d in data]
+            hp, hidden = forward(model, x, t, m, l)
+            (hp.sum() + hidden.sum()).backward()
+
+    def current(model, x, t, m, l):
+        return model.forward_batch(x, t, m, l)
+
+    print('{:>10} {:>25} {:>15}'.format('Length', 'Model', 'Epoch (s)'))
+    for mean_length in [10, 30]:
+        x, i, m, e, t = synthetic_joint(2000, seed = args.seed, mean_length = mean_length)
+        x, i, m, _, l, _ = RNNJoint.to_tensors(x, i, m, e, t)
+        data = [x, i, m, l]
+        for name, forward, model in [('GRU-D legacy', legacy, RNN(x.shape[-1], 'GRUD')),
+                                     ('GRU-D', current, RNN(x.shape[-1], 'GRUD')),
+                                     ('GRU-D TorchScript', current, RNN(x.shape[-1], 'GRUD', recurrent_args = {'script': True})),
+                                     ('GRU (packed)', current, RNN(x.shape[-1], 'GRU'))]:
+            model = model.to(x.dtype)
+            epoch(forward, model, data) # Warm up (TorchScript compilation)
+            print('{:>10} {:>25} {:>15.3f}'.format(mean_length, name, timeit(epoch, forward, model, data)))
+
+def bench_ode(batch = 250):
+    import torch
+    from models.RNN.rnn import RNN
+    from models.rnn_joint import RNNJoint
+
+    def legacy_solver(solver, x, t):
+        # Previous solver (odeint euler): steps on the grid of all patients' times and linspace, states kept at each point
+        times, indices = solver.split_time(t)
+        states = [x]
+        for j in range(1, len(times)):
+            x = x + (times[j] - times[j - 1]) * solver.ode_func(times[j - 1], x)
+            states.append(x)
+        states = torch.stack(states, 2)
+        return torch.gather(states, 2, indices.repeat(1, states.size(1), 1)).squeeze(2)
+
+    def epoch(model, data):
+        for j in range(0, len(data[0]), batch):
+            hp, hidden = model.forward_batch(*[d[j:j + batch] for d in data])
+            (hp.sum() + hidden.sum()).backward()
+
+    x, i, m, e, t = synthetic_joint(1000, seed = args.seed)
+    x, i, m, _, l, _ = RNNJoint.to_tensors(x, i, m, e, t)
+    i = i * 24 # Interevent times in hours (synthetic times are in [0, 1])
+    data = [x, i, m, l]
+    print('{:>10} {:>25} {:>15}'.format('Step', 'Model', 'Epoch (s)'))
+    for step in [1., 0.25]:
+        model = RNN(x.shape[-1], 'ODE', recurrent_args = {'step_size': step}).to(x.dtype)
+        print('{:>10} {:>25} {:>15.3f}'.format(step, 'ODE fixed step', timeit(epoch, model, data)))
+        solver = model.embedding.cell.ode
+        solver.forward = lambda x, t: legacy_solver(solver, x, t)
+        print('{:>10} {:>25} {:>15.3f}'.format(step, 'ODE grid (legacy)', timeit(epoch, model, data, repeat = 1)))
+    print('{:>10} {:>25} {:>15.3f}'.format('-', 'GRU-D', timeit(epoch, RNN(x.shape[-1], 'GRUD').to(x.dtype), data)))
+
+def bench_point(steps = 20):
+    import torch
+    from models.Observational.temporal import Point
+
+    def legacy(model, h, i):
+        # Previous forward: two evaluations and intensity by double backward
+        tau = torch.flatten(i[:, 1:].unsqueeze(-1), 0, 1).requires_grad_()
+        hidden_tau = torch.flatten(h[:, :-1, :], 0, 1)
+        cumulative = model.cumulative(torch.cat((hidden_tau, tau), 1).unsqueeze(0)) - model.cumulative(torch.cat((hidden_tau, torch.zeros_like(tau)), 1).unsqueeze(0))
+        cumulative = cumulative.reshape([h.shape[0], h.shape[1] - 1])
+        gradient = torch.autograd.grad(torch.mean(cumulative), tau, create_graph = True)[0].reshape([h.shape[0], h.shape[1] - 1])
+        return torch.exp(-cumulative), gradient, cumulative
+
+    def step(forward, model, h, i):
+        for _ in range(steps):
+            _, gradient, cumulative = forward(model, h, i)
+            (cumulative.sum() - torch.log(gradient.clamp(min = 1e-8)).sum()).backward()
+
+    def single(forward, model, h, i):
+        _, gradient, cumulative = forward(model, h, i)
+        (cumulative.sum() - torch.log(gradient.clamp(min = 1e-8)).sum()).backward()
+
+    def analytic(model, h, i):
+        return model.forward_batch(h, i, None, None)
+
+    print('{:>8} {:>12} {:>15} {:>15} {:>15} {:>15}'.format('Points', 'Layers', 'Legacy (ms)', 'Analytic (ms)', 'Legacy (MB)', 'Analytic (MB)'))
+    rng = np.random.default_rng(args.seed)
+    for layers in [[100], [50, 50]]:
+        for patients in [100, 1000]:
+            torch.manual_seed(args.seed)
+            model = Point(10, 1, {'layers': layers}).double()
+            h = torch.tensor(rng.normal(size = (patients, 10, 10)), requires_grad = True)
+            i = torch.tensor(rng.uniform(size = (patients, 10)))
+            print('{:>8} {:>12} {:>15.3f} {:>15.3f} {:>15.2f} {:>15.2f}'.format(patients * 9, str(layers),
+                1000 * timeit(step, legacy, model, h, i) / steps, 1000 * timeit(step, analytic, model, h, i) / steps,
+                graph_memory(single, legacy, model, h, i), graph_memory(single, analytic, model, h, i)))
+
+def bench_heads(steps = 20):
+    import torch
+    from models.Observational.longitudinal import Neural as Longitudinal
+    from models.Observational.missing import Bernoulli
+    from models.Observational.longitudinal import Gaussian
+
+    def legacy_longitudinal(model, h, i):
+        # Previous forward: whole network on the concatenation with tau and with zero
+        tau, h_time = i[:, 1:].unsqueeze(-1), h[:, :-1, :]
+        mean_var = model.mean_var(torch.cat((h_time, tau), 2).unsqueeze(0))[0]
+        mean_0 = model.mean_var(torch.cat((h_time, torch.zeros_like(tau)), 2).unsqueeze(0))[0, :, :, :model.outputdim]
+        return mean_var[:, :, :model.outputdim] - mean_0, model.softplus(mean_var[:, :, model.outputdim:])
+
+    def legacy_gaussian(model, h, i):
+        # Previous forward: latent repeated for each point, with tau and with zero
+        tau = i[:, 1:].unsqueeze(-1)
+        latent = model.latent[0].repeat((len(h), tau.shape[1], 1))
+        mean_var = model.mean_var(torch.cat((latent, tau), 2).unsqueeze(0))[0]
+        mean_0 = model.mean_var(torch.cat((latent, torch.zeros_like(tau)), 2).unsqueeze(0))[0, :, :, :model.outputdim]
+        return mean_var[:, :, :model.outputdim] - mean_0, model.softplus(mean_var[:, :, model.outputdim:])
+
+    def legacy_bernoulli(model, h, i):
+        tau = i[:, 1:].unsqueeze(-1)
+        return model.missing(torch.cat((model.latent[0].repeat((len(h), tau.shape[1], 1)), tau), 2).unsqueeze(0))[0],
+
+    def fused(model, h, i):
+        return model.forward_batch(h, i, None, None)
+
+    def step(forward, model, h, i):
+        sum(output.sum() for output in forward(model, h, i)).backward()
+
+    def steps_timed(forward, model, h, i):
+        for _ in range(steps):
+            step(forward, model, h, i)
+
+    print('{:>15} {:>8} {:>15} {:>15} {:>15} {:>15}'.format('Head', 'Hidden', 'Legacy (ms)', 'Fused (ms)', 'Legacy (MB)', 'Fused (MB)'))
+    rng = np.random.default_rng(args.seed)
+    for hidden in [10, 100]:
+        h = torch.tensor(rng.normal(size = (500, 20, hidden)), requires_grad = True)
+        i = torch.tensor(rng.uniform(size = (500, 20)))
+        for name, model, legacy in [('Longitudinal', Longitudinal(hidden, 10).double(), legacy_longitudinal),
+                                    ('Gaussian', Gaussian(hidden, 10).double(), legacy_gaussian),
+                                    ('Bernoulli', Bernoulli(hidden, 10).double(), legacy_bernoulli)]:
+            print('{:>15} {:>8} {:>15.3f} {:>15.3f} {:>15.2f} {:>15.2f}'.format(name, hidden,
+                1000 * timeit(steps_timed, legacy, model, h, i) / steps, 1000 * timeit(steps_timed, fused, model, h, i) / steps,
+                graph_memory(step, legacy, model, h, i), graph_memory(step, fused, model, h, i)))
+
+def bench_mixture(steps = 10):
+    import torch
+    from models.mixture import Mixture
+
+    def split(model):
+        # Previous layout: one network by component (copies of the stacked parameters)
+        components = []
+        for j in range(model.k):
+            component = Mixture(1, model.inputdim, model.outputdim, 'point', {}, 'neural', {}, 'neural', {}).double()
+            component.load_state_dict({name: value[j:j + 1] for name, value in model.state_dict().items() if not name.startswith('alphas')}, strict = False)
+            components.append(component)
+        return components
+
+    def legacy(model, components, h, x, i, m, l):
+        # Previous loss: one forward by component and alpha repeated on the outputs
+        alphas = model.alphas(h[:, :-1])
+        loss_temp = loss_long = loss_miss = 0
+        for j, component in enumerate(components):
+            alpha = alphas[:, :, j].unsqueeze(0)
+            alphas_repeat = alpha.unsqueeze(-1).repeat(1, 1, 1, x.size(2))
+            loss_temp = loss_temp + component.temporal.loss(alpha, h, i, m, l)
+            loss_long = loss_long + component.longitudinal.loss(alphas_repeat, h, x, i, m, l)
+            loss_miss = loss_miss + component.missing.loss(alphas_repeat, h, i, m, l)
+        return loss_temp, loss_long, loss_miss
+
+    def stacked(model, components, h, x, i, m, l):
+        return model.loss(h, x, i, m, l)
+
+    def step(loss, *data):
+        sum(loss(*data)).backward()
+
+    def steps_timed(loss, *data):
+        for _ in range(steps):
+            step(loss, *data)
+
+    print('{:>5} {:>10} {:>15} {:>15} {:>10}'.format('k', 'Hidden', 'Legacy (ms)', 'Stacked (ms)', 'Same'))
+    rng = np.random.default_rng(args.seed)
+    for hidden in [10, 50]:
+        h = torch.tensor(rng.normal(size = (250, 20, hidden)), requires_grad = True)
+        x = torch.tensor(rng.normal(size = (250, 20, 10)))
+        i = torch.tensor(rng.uniform(size = (250, 20)))
+        m = torch.tensor(rng.uniform(size = (250, 20, 10)) > 0.3)
+        l = torch.tensor(rng.integers(2, 21, size = 250))
+        for k in [1, 3, 5]:
+            torch.manual_seed(args.seed)
+            model = Mixture(k, hidden, 10, 'point', {}, 'neural', {}, 'neural', {}).double()
+            components = split(model)
+            same = all(torch.allclose(a, b) for a, b in zip(legacy(model, components, h, x, i, m, l), stacked(model, components, h, x, i, m, l)))
+            print('{:>5} {:>10} {:>15.3f} {:>15.3f} {:>10}'.format(k, hidden,
+                1000 * timeit(steps_timed, legacy, model, components, h, x, i, m, l) / steps,
+                1000 * timeit(steps_timed, stacked, model, components, h, x, i, m, l) / steps, str(same)))
+
+    # Observational predictions with heads not modelled and a mixture mask (zeros for the missing heads)
+    from models.rnn_joint import RNNJoint
+    x, i, m, e, t = synthetic_joint(100, d = 4, seed = args.seed)
+    mask = np.array([True, False, True, False])
+    for heads in [{'longitudinal': 'neural'}, {'temporal': 'point', 'missing': 'neural'}, {'temporal': 'weibull', 'observational_components': 2}]:
+        model = RNNJoint(x.shape[1], 1, cuda = False, mixture_mask = mask, **heads)
+        model.fit(x, i, m, e, t, epochs = 1, pretrain_ite = 0, batch = 50)
+        temporal, longitudinal, missing, _ = model.observational_predict(x, i, m, batch = 30)
+        assert temporal.shape + (mask.sum(),) == longitudinal.shape == missing.shape, 'Observational predictions of inconsistent shapes'
+        print('Partial heads {}: observational predictions {}'.format(heads, [temporal.shape, longitudinal.shape, missing.shape]))
+
+benchmarks = {
+    'split': bench_split,
+    'pad': bench_pad,
+    'bucket': bench_bucket,
+    'dtype': bench_dtype,
+    'pruning': bench_pruning,
+    'bank': bench_bank,
+    'snapshot': bench_snapshot,
+    'loader': bench_loader,
+    'cox': bench_cox,
+    'baseline': bench_baseline,
+    'horizon': bench_horizon,
+    'grud': bench_grud,
+    'ode': bench_ode,
+    'point': bench_point,
+    'heads': bench_heads,
+    'mixture': bench_mixture,
+}
+
+if args.bench not in benchmarks:
+    raise ValueError('Benchmark {} unknown'.format(args.bench))
+benchmarks[args.bench]()
@@ -0,0 +1,192 @@
+from pandas.api.types import is_object_dtype, is_string_dtype
+from collections import OrderedDict
+import pandas as pd
+import numpy as np
+import inspect
+import hashlib
+import pickle
+import shutil
+import json
+import os
+
+def read_csv(path, cache = True, **kwargs):
+    """
+        Reads a csv through a binary columnar cache (next to the csv in path.cache)
+        Index levels and columns are stored as numpy arrays (memory mapped at loading)
+        The cache is rebuilt when the source csv changes
+
+        Args:
+            path (str): Path to the csv
+            cache (bool): Use the cache (pd.read_csv otherwise)
+            kwargs: Arguments for pd.read_csv (part of the cache key)
+
+        Returns:
+            Dataframe: Same as pd.read_csv(path, **kwargs)
+    """
+    if not cache:
+        return pd.read_csv(path, **kwargs)
+
+    key = hashlib.sha1(repr(sorted(kwargs.items())).encode()).hexdigest()[:10]
+    directory = os.path.join(path + '.cache', key)
+    source = _source(path)
+
+    if os.path.isfile(os.path.join(directory, 'meta.json')):
+        with open(os.path.join(directory, 'meta.json')) as meta_file:
+            meta = json.load(meta_file)
+        if meta['source'] == source:
+            return _load(directory, meta)
+        shutil.rmtree(directory, ignore_errors = True)
+
+    data = pd.read_csv(path, **kwargs)
+    _save(data, directory, source)
+    return data
+
+def _source(path):
+    # Identifies the version of the csv
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def _array(values):
+    # Numpy array to save (objects - strings or mixed - are pickled)
+    if is_object_dtype(values.dtype) or is_string_dtype(values.dtype):
+        return np.asarray(values, dtype = object)
+    return np.asarray(values)
+
+def _save(data, directory, source):
+    """
+        Saves the dataframe column by column in a temporary directory moved once complete
+        (Concurrent processes only use complete caches)
+    """
+    temporary = '{}.{}.tmp'.format(directory, os.getpid())
+    os.makedirs(temporary, exist_ok = True)
+
+    for j in range(data.shape[1]):
+        np.save(os.path.join(temporary, 'column_{}.npy'.format(j)), _array(data.iloc[:, j]))
+    for k in range(data.index.nlevels):
+        np.save(os.path.join(temporary, 'index_{}.npy'.format(k)), _array(data.index.get_level_values(k)))
+
+    meta = {
+        'source': source,
+        'columns': [list(c) if isinstance(c, tuple) else c for c in data.columns],
+        'columns_names': list(data.columns.names),
+        'index_names': list(data.index.names),
+    }
+    with open(os.path.join(temporary, 'meta.json'), 'w') as meta_file:
+        json.dump(meta, meta_file)
+
+    try:
+        os.replace(temporary, directory)
+    except OSError:
+        # Another process has already saved the cache
+        shutil.rmtree(temporary, ignore_errors = True)
+
+def _read(path):
+    # Memory map when possible
+    try:
+        return np.load(path, mmap_mode = 'r')
+    except ValueError:
+        return np.load(path, allow_pickle = True)
+
+def _load(directory, meta):
+    index = [_read(os.path.join(directory, 'index_{}.npy'.format(k))) for k in range(len(meta['index_names']))]
+    if len(index) > 1:
+        index = pd.MultiIndex.from_arrays(index, names = meta['index_names'])
+    else:
+        index = pd.Index(index[0], name = meta['index_names'][0])
+
+    columns = meta['columns']
+    if len(meta['columns_names']) > 1:
+        columns = pd.MultiIndex.from_tuples([tuple(c) for c in columns], names = meta['columns_names'])
+    else:
+        columns = pd.Index(columns, name = meta['columns_names'][0])
+
+    data = {j: _read(os.path.join(directory, 'column_{}.npy'.format(j))) for j in range(len(columns))}
+    data = pd.DataFrame(data, index = index)
+    data.columns = columns
+    return data
+
+def hash_data(*args):
+    """
+        Content hash of the given data (values and index)
+        Strings are used as already computed keys
+    """
+    content = hashlib.sha1()
+    for arg in args:
+        if arg is None:
+            content.update(b'None')
+        elif isinstance(arg, str):
+            content.update(arg.encode())
+        else:
+            content.update(pd.util.hash_pandas_object(arg, index = True).values.tobytes())
+    return content.hexdigest()
+
+def hash_source(*functions):
+    """
+        Hash of the source code of the given functions (or modules)
+        Used as key of a computation: changes when the code changes
+    """
+    content = hashlib.sha1()
+    for function in functions:
+        try:
+            content.update(inspect.getsource(function).encode())
+        except (OSError, TypeError):
+            # Source not available: never reused across runs
+            content.update(repr(function).encode())
+    return content.hexdigest()
+
+class FeatureStore():
+    """
+        Content addressed store of derived features
+        A feature is identified by its name, the content of its inputs and the source of its function
+        Recently used features are kept in memory, all are saved on disk
+    """
+
+    def __init__(self, path = None, size = 4):
+        """
+        Args:
+            path (str, optional): Directory to save features (None: only in memory). Defaults to None.
+            size (int, optional): Number of features kept in memory. Defaults to 4.
+        """
+        self.path = path
+        self.size = size
+        self.memory = OrderedDict()
+
+    def get(self, name, function, *inputs):
+        """
+            Returns function(), computed only if not already stored for these inputs
+
+            Args:
+                name (str): Name of the feature
+                function (callable): Computes the feature (no arguments)
+                inputs: Data (or keys) from which the feature is computed
+                    (Add hash_source of the code called by function if not in its source)
+
+            Returns:
+                Feature
+        """
+        key = '{}_{}'.format(name, hash_data(hash_source(function), *inputs))
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+
+        file = None if self.path is None else os.path.join(self.path, key + '.pickle')
+        if file is not None and os.path.isfile(file):
+            with open(file, 'rb') as feature_file:
+                feature = pickle.load(feature_file)
+        else:
+            feature = function()
+            if file is not None:
+                self._save(feature, file)
+
+        self.memory[key] = feature
+        if len(self.memory) > self.size:
+            self.memory.popitem(last = False)
+        return feature
+
+    def _save(self, feature, file):
+        # Temporary file moved once complete (Concurrent processes)
+        os.makedirs(self.path, exist_ok = True)
+        temporary = '{}.{}.tmp'.format(file, os.getpid())
+        with open(temporary, 'wb') as feature_file:
+            pickle.dump(feature, feature_file)
+        os.replace(temporary, file)
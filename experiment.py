@@ -2,22 +2,101 @@ from sklearn.model_selection import ParameterSampler, train_test_split
 from sklearn.preprocessing import StandardScaler
 from models.rnn_joint import RNNJoint
 from models.deepsurv import DeepSurv
+from collections import OrderedDict
+from contextlib import nullcontext
+from functools import partial
+from dataset import hash_data
+from time import perf_counter
+import multiprocessing
 import pandas as pd
 import numpy as np
 import pickle
 import torch
+import json
+import glob
 import os
-import io
 
-class CPU_Unpickler(pickle.Unpickler):
+# Preprocessed tensors shared across experiments (keyed on content - not saved with the experiment)
+preprocessed_cache, preprocessed_cache_size = OrderedDict(), 8
+
+# Experiment and data of the running hyperparameter search (inherited by forked workers)
+search_data = None
+
+def _init_worker(threads):
+    torch.set_num_threads(threads)
+
+def _fit_configuration(configuration):
+    """
+        Fits one hyperparameter configuration (index, hyperparameter) and evaluates it on dev
+    """
+    index, hyperparameter = configuration
+    experiment, train, val, dev, inputdim, outputdim, repeats = search_data
+    start = perf_counter()
+    pruning = None if experiment.pruner is None else partial(experiment.pruner.report, index)
+    model = experiment._fit(train, val, hyperparameter, inputdim, outputdim, repeats, pruning, experiment._checkpoint(index))
+    nll = None if model is None else experiment._nll(model, dev)
+    return index, hyperparameter, model, nll, perf_counter() - start
+
+def _fit_worker(configuration):
+    # Pickled model is copied to the parent (not shared memory kept alive by the worker)
+    return pickle.dumps(_fit_configuration(configuration))
+
+class SuccessiveHalving():
     """
-        Allow reloading of a GPU model on a CPU machine
+        Asynchronous successive halving (ASHA) of hyperparameter configurations
+        Rungs are at min_epochs * reduction^k epochs: a configuration continues only if its
+        best validation loss is among the best 1 / reduction reported at this rung
+        (by the previous configurations and the ones running in parallel)
+        No configuration is stopped at a rung with fewer than reduction reports
     """
-    def find_class(self, module, name):
-        if module == 'torch.storage' and name == '_load_from_bytes':
-            return lambda b: torch.load(io.BytesIO(b), map_location = 'cpu')
-        else: 
-            return super().find_class(module, name)
+
+    def __init__(self, min_epochs = 10, reduction = 3):
+        self.min_epochs = min_epochs
+        self.reduction = reduction
+        self.rungs = {} # Rung -> {Configuration index: loss}
+        self.lock = None
+
+    def report(self, configuration, epoch, loss):
+        """
+            Records the loss of the configuration after the given number of epochs
+
+            Returns:
+                bool: True if the configuration should be stopped
+        """
+        rung = self.min_epochs
+        while rung < epoch:
+            rung *= self.reduction
+        if rung != epoch:
+            return False
+
+        with self.lock or nullcontext():
+            losses = dict(self.rungs.get(rung, {}))
+            losses[configuration] = loss # Overwrites a report of a configuration interrupted before saving
+            self.rungs[rung] = losses
+
+        # Too few reports at this rung to tell whether the configuration is losing
+        if len(losses) < self.reduction:
+            return False
+
+        ranked = np.sort(list(losses.values()))
+        return loss > ranked[len(ranked) // self.reduction - 1]
+
+    def share(self, manager):
+        # Rungs shared between processes
+        self.rungs, self.lock = manager.dict(self.rungs), manager.Lock()
+
+    def unshare(self):
+        self.rungs, self.lock = dict(self.rungs), None
+
+    def reports(self, configuration):
+        """
+            Losses reported by the configuration (Rung -> loss)
+        """
+        return {rung: losses[configuration] for rung, losses in self.rungs.items() if configuration in losses}
+
+    def restore(self, configuration, reports):
+        for rung, loss in reports.items():
+            self.rungs.setdefault(int(rung), {})[configuration] = loss
 
 class ToyExperiment():
 
@@ -27,7 +106,7 @@ class ToyExperiment():
 class ShiftExperiment():
 
     def __init__(self, model = 'joint', hyper_grid = None, n_iter = 100, 
-                random_seed = 0, times = [1, 7, 14, 30], normalization = True, path = 'results', save = True):
+                random_seed = 0, times = [1, 7, 14, 30], normalization = True, path = 'results', save = True, pruning = None):
         self.model = model
         self.hyper_grid = list(ParameterSampler(hyper_grid, n_iter = n_iter, random_state = random_seed) if hyper_grid is not None else [{}])
         self.random_seed = random_seed
@@ -40,44 +119,62 @@ class ShiftExperiment():
         self.normalization = normalization
         self.path = path
         self.tosave = save
+        self.pruner = None if pruning is None else SuccessiveHalving(**pruning)
 
     @classmethod
     def create(cls, model = 'joint', hyper_grid = None, n_iter = 100, 
-                random_seed = 0, times = [1, 7, 14, 30], path = 'results', normalization = True, force = False, save = True):
+                random_seed = 0, times = [1, 7, 14, 30], path = 'results', normalization = True, force = False, save = True, pruning = None):
         print(path)
+        obj = cls(model, hyper_grid, n_iter, random_seed, times, normalization, path, save, pruning)
         if not(force):
             if os.path.isfile(path + '.csv'):
                 return ToyExperiment()
-            elif os.path.isfile(path + '.pickle'):
+            elif os.path.isfile(path + '.results.jsonl'):
+                # Errors are raised: the saved state is kept (use force to restart)
                 print('Loading previous copy')
-                try:
-                    obj = cls.load(path + '.pickle')
-                    obj.times = times
-                    return obj
-                except:
-                    print('ERROR: Reinitalizing object')
-                    os.remove(path + '.pickle')
-                    pass
+                return obj.load()
+
+        # New experiment: remove the state and checkpoints of a previous one
+        for file in [path + '.results.jsonl', path + '.best.pt'] + glob.glob(glob.escape(path) + '.*.checkpoint'):
+            if os.path.isfile(file):
+                os.remove(file)
                 
-        return cls(model, hyper_grid, n_iter, random_seed, times, normalization, path, save)
+        return obj
 
-    @staticmethod
-    def load(path):
-        file = open(path, 'rb')
-        if torch.cuda.is_available():
-            return pickle.load(file)
-        else:
-            se = CPU_Unpickler(file).load()
-            se.best_model.cuda = False
-            return se
-
-    @staticmethod
-    def save(obj):
-        with open(obj.path + '.pickle', 'wb') as output:
-            try:
-                pickle.dump(obj, output)
-            except Exception as e:
-                print('Unable to save object')
+    def load(self):
+        """
+            Restores the search from the saved state
+            Results of the fitted configurations (appended by save) and best model
+        """
+        with open(self.path + '.results.jsonl') as results:
+            for line in results:
+                if not line.endswith('\n'):
+                    break # Interrupted while writing
+                result = json.loads(line)
+                if self.pruner is not None:
+                    self.pruner.restore(result['index'], result['rungs'])
+                self.iter += 1
+
+        if os.path.isfile(self.path + '.best.pt'):
+            best = torch.load(self.path + '.best.pt', map_location = 'cpu', weights_only = True)
+            self.best_nll, self.best_hyper = best['nll'], self.hyper_grid[best['index']]
+            self.best_model = (RNNJoint if self.model == 'joint' else DeepSurv).from_state_dict(best['model'])
+        return self
+
+    def save(self, index, nll, duration, best):
+        """
+            Appends the results of the configuration (and saves the model if best)
+            Constant cost by configuration - Read by load
+        """
+        if best:
+            temporary = '{}.best.pt.{}.tmp'.format(self.path, os.getpid())
+            torch.save({'index': index, 'nll': self.best_nll, 'model': self.best_model.state_dict()}, temporary)
+            os.replace(temporary, self.path + '.best.pt')
+
+        result = {'index': index, 'hyperparameter': self.hyper_grid[index], 'nll': nll, 'time': duration,
+                  'rungs': {} if self.pruner is None else self.pruner.reports(index)}
+        with open(self.path + '.results.jsonl', 'a') as results:
+            results.write(json.dumps(result, default = str) + '\n')
                 
     def save_results(self, predictions, used):
         res = pd.concat([predictions, used], axis = 1)
@@ -87,7 +184,7 @@ class ShiftExperiment():
 
         return res
 
-    def train(self, covariates, time, event, training, interevent = None, mask = None, oversampling_ratio = 0.):
+    def train(self, covariates, time, event, training, interevent = None, mask = None, oversampling_ratio = 0., n_jobs = 1, bank = False):
         """
             Model is selected with train / test split and maximum likelihood
 
@@ -99,6 +196,8 @@ class ShiftExperiment():
                 event (Dataframe n): Event indicator
                 training (Dataframe n): Indicate which points should be used for training
                 oversampling_ratio (float): Over sample data in the training set.
+                n_jobs (int): Number of hyperparameters fitted in parallel.
+                bank (bool): Fit hyperparameters differing only by learning rate in lockstep (deepsurv only, without pruning).
 
             Returns:
                 (Dict, Dict): Dict of fitted model and Dict of observed performances
@@ -120,16 +219,16 @@ class ShiftExperiment():
             self.normalizer = StandardScaler().fit(covariates.loc[training_index])
             covariates = pd.DataFrame(self.normalizer.transform(covariates), index = covariates.index)
 
-        # Oversample training data
-        oversampling = training_index
+        # Oversample training data (number of times each patient is used - no copy)
+        repeats = None
         if oversampling_ratio > 0:
-            oversampling = pd.Series(training_index).sample(frac = oversampling_ratio, replace = True).values
+            repeats = np.bincount(pd.Series(training_index).sample(frac = oversampling_ratio, replace = True).index, minlength = len(training_index))
 
         # Split data
-        train_cov, train_time, train_event = select(covariates, oversampling), select(time, oversampling), \
-                                             select(event, oversampling)
-        train_ie = None if interevent is None else select(interevent, oversampling)
-        train_mask = None if mask is None else select(mask, oversampling)
+        train_cov, train_time, train_event = select(covariates, training_index), select(time, training_index), \
+                                             select(event, training_index)
+        train_ie = None if interevent is None else select(interevent, training_index)
+        train_mask = None if mask is None else select(mask, training_index)
 
         dev_cov, dev_time, dev_event = covariates.loc[dev_index], time.loc[dev_index], \
                                             event.loc[dev_index]
@@ -141,24 +240,28 @@ class ShiftExperiment():
         val_ie = None if interevent is None else interevent.loc[val_index]
         val_mask = None if mask is None else mask.loc[val_index]
 
+        # Preprocess once for all hyperparameters
+        train = self._preprocess(train_cov, train_ie, train_mask, train_event, train_time)
+        val = self._preprocess(val_cov, val_ie, val_mask, val_event, val_time)
+        dev = self._preprocess(dev_cov, dev_ie, dev_mask, dev_event, dev_time)
+        outputdim = len(train_event.unique()) - 1
+
         # Train on subset one domain
         ## Grid search best params
-        for i, hyper in enumerate(self.hyper_grid):
-            if i < self.iter:
-                # When object is reloaded - Avoid to recompute same parameters
-                continue
-            model = self._fit(train_cov, train_ie, train_mask, train_event, train_time, hyper, 
-                                val_cov, val_ie, val_mask, val_event, val_time)
-
+        # When object is reloaded - Avoid to recompute same parameters
+        configurations = list(enumerate(self.hyper_grid))[self.iter:]
+        for index, hyper, model, nll, duration in self._search(configurations, train, val, dev, len(train_cov.columns), outputdim, repeats, n_jobs, bank):
+            best = False
             if model is not None:
-                nll = self._nll(model, dev_cov, dev_ie, dev_mask, dev_event, dev_time)
+                nll = float(nll)
                 if nll < self.best_nll:
                     self.best_hyper = hyper
                     self.best_model = model
                     self.best_nll = nll
+                    best = True
 
             self.iter += 1
-            ShiftExperiment.save(self)
+            self.save(index, nll, duration, best)
 
         return self.save_results(self.predict(covariates, interevent, mask, training.index), annotated_training)
 
@@ -176,48 +279,158 @@ class ShiftExperiment():
         """
         if self.best_model is None:
             raise ValueError('Model not trained - Call .fit')
-        return pd.DataFrame(1 - self.best_model.predict(covariates, interevent, mask, horizon = self.times, risk = 1, batch = 50), index = index, columns = self.times)
+        data = self._preprocess(covariates, interevent, mask)
+        return pd.DataFrame(1 - self.best_model.predict(data, None, None, horizon = self.times, risk = 1), index = index, columns = self.times)
+
+    def _search(self, configurations, train, val, dev, inputdim, outputdim, repeats = None, n_jobs = 1, bank = False):
+        """
+            Fits the configurations (index, hyperparameter) and yields (index, hyperparameter, model, dev nll, fit time) in the grid order
+            With n_jobs > 1, a pool of forked processes fits them in parallel:
+            workers share the preprocessed tensors (shared memory) and split the threads
+            With bank, the remaining configurations differing only by learning rate are fitted
+            together when the first one is reached
+            Each configuration is seeded on its own (same models whatever n_jobs or bank)
+            Pruned configurations are returned without model
+        """
+        if bank and (self.model != 'deepsurv' or n_jobs > 1):
+            raise ValueError('Model bank only available for deepsurv without n_jobs (recurrent kernels cannot be vectorized)')
+        if bank and self.pruner is not None:
+            # Members of a bank reach the rungs before the configurations between them in the grid:
+            # the rungs would differ from the sequential search (and so the pruned configurations)
+            raise ValueError('Model bank cannot be combined with pruning (rungs reported out of the grid order)')
+
+        global search_data
+        search_data = (self, train, val, dev, inputdim, outputdim, repeats)
+        manager = None
+        try:
+            if bank:
+                fitted = {} # Configurations already fitted with a previous one
+                for index, hyper in configurations:
+                    if index not in fitted:
+                        structure = {k: v for k, v in hyper.items() if k != 'lr'}
+                        group = [(i, h) for i, h in configurations if i >= index and i not in fitted and \
+                                    {k: v for k, v in h.items() if k != 'lr'} == structure]
+                        start = perf_counter()
+                        models = self._fit_bank(train, val, [h for _, h in group], inputdim, outputdim, repeats)
+                        duration = (perf_counter() - start) / len(group) # Shared fit
+                        for (i, h), model in zip(group, models):
+                            fitted[i] = (i, h, model, None if model is None else self._nll(model, dev), duration)
+                    yield fitted.pop(index)
+            elif n_jobs == 1:
+                for configuration in configurations:
+                    yield _fit_configuration(configuration)
+            else:
+                if self.pruner is not None:
+                    manager = multiprocessing.get_context('fork').Manager()
+                    self.pruner.share(manager)
+
+                for data in (train, val, dev):
+                    for tensor in data:
+                        if tensor is not None:
+                            tensor.share_memory_()
+
+                threads = max(1, torch.get_num_threads() // n_jobs)
+                with multiprocessing.get_context('fork').Pool(n_jobs, _init_worker, (threads,)) as pool:
+                    for result in pool.imap(_fit_worker, configurations):
+                        yield pickle.loads(result)
+        finally:
+            search_data = None
+            if manager is not None:
+                self.pruner.unshare()
+                manager.shutdown()
+
+    def _preprocess(self, covariates, interevent, mask, event = None, time = None):
+        """
+            Converts data into the model's tensors
+            Computed once for identical content and shared across hyperparameters and experiments
+        """
+        key = (self.model, hash_data(covariates, interevent, mask, event, time))
+        if key in preprocessed_cache:
+            preprocessed_cache.move_to_end(key)
+            return preprocessed_cache[key]
+
+        if self.model == "joint":
+            data = RNNJoint.to_tensors(covariates, interevent, mask, event, time)
+        elif self.model == "deepsurv":
+            data = DeepSurv.to_tensors(covariates, event, time)
+        else:
+            raise ValueError('Model {} unknown'.format(self.model))
+
+        preprocessed_cache[key] = data
+        if len(preprocessed_cache) > preprocessed_cache_size:
+            preprocessed_cache.popitem(last = False)
+        return data
             
-    def _fit(self, covariates, interevent, mask, event, time, hyperparameter, val_cov, val_ie, val_mask, val_event, val_time):
+    def _checkpoint(self, index):
+        """
+            Path of the training checkpoint of the given configuration
+            (An experiment reloaded by create resumes the interrupted configurations from it)
+        """
+        return '{}.{}.checkpoint'.format(self.path, index)
+
+    def _fit(self, train, val, hyperparameter, inputdim, outputdim, repeats = None, pruning = None, checkpoint = None):
         """
-            Fits the model on the given data
+            Fits the model on the given preprocessed data
+            (repeats: number of times each training patient is used)
+            (pruning: called with the number of epochs and best validation loss - stops training if True)
+            (checkpoint: path to save the training state at each epoch and resume from)
         """
+        hyperparameter = dict(hyperparameter) # Grid kept intact for the results
         np.random.seed(self.random_seed)
         torch.manual_seed(self.random_seed)
-        inputdim = len(covariates.columns)
-        outputdim = len(event.unique()) - 1
 
         lr = hyperparameter.pop('lr', 0.0001)
         batch = hyperparameter.pop('batch', 500)
         full = hyperparameter.pop('full_finetune', False)
+        bucket = hyperparameter.pop('bucket', 0)
 
         if self.model == "joint":
             model = RNNJoint(inputdim, outputdim, **hyperparameter)
-            return model.fit(covariates, interevent, mask, event, time,
-                             val_cov, val_ie, val_mask, val_event, val_time, lr = lr, batch = batch, full_finetune = full)
+            return model.fit(train, None, None, None, None,
+                             val, repeats = repeats, lr = lr, batch = batch, full_finetune = full, bucket = bucket, pruning = pruning, checkpoint = checkpoint)
         elif self.model == "deepsurv":
             model = DeepSurv(inputdim, outputdim, **hyperparameter)
-            return model.fit(covariates, event, time,
-                             val_cov, val_event, val_time, lr = lr, batch = batch)
+            return model.fit(train, None, None,
+                             val, repeats = repeats, lr = lr, batch = batch, pruning = pruning, checkpoint = checkpoint)
         else:
              raise ValueError('Model {} unknown'.format(self.model))
         
-    def _nll(self, model, covariates, interevent, mask, event, time):
+    def _fit_bank(self, train, val, hyperparameters, inputdim, outputdim, repeats = None):
+        """
+            Fits models differing only by learning rate in lockstep on the given preprocessed data
+            (Same initialization and batches than _fit for each hyperparameter)
+        """
+        np.random.seed(self.random_seed)
+
+        models, lrs = [], []
+        for hyperparameter in hyperparameters:
+            hyperparameter = dict(hyperparameter)
+            torch.manual_seed(self.random_seed)
+            lrs.append(hyperparameter.pop('lr', 0.0001))
+            batch = hyperparameter.pop('batch', 500)
+            models.append(DeepSurv(inputdim, outputdim, **hyperparameter))
+
+        return DeepSurv.fit_bank(models, train, None, None,
+                                 val, repeats = repeats, lr = lrs, batch = batch)
+
+    def _nll(self, model, data):
         """
-            Computes the negative loglikelihood of the model on the given data
+            Computes the negative loglikelihood of the model on the given preprocessed data
         """
-        return model.loss(covariates, interevent, mask, event, time)
+        return model.loss(data, None, None, None, None)
 
-def select(df, oversample):
+def select(df, index):
     """
-        Allows to select from a multi index with over sampling
-        Ensure that the each resampled patients will have a different index
+        Allows to select patients from a multi index (in the order of index)
+        Each selected patient is relabeled by its position in index
     """
     if df.index.nlevels > 1:
-        results = {}
-        for i, patient in enumerate(oversample):
-            patient_df = df.loc[patient]
-            results[i] = patient_df
-        return pd.concat(results)
+        position = pd.Index(index).get_indexer(df.index.get_level_values(0))
+        rows = np.argsort(position, kind = 'stable')
+        rows = rows[position[rows] >= 0]
+        selection = df.iloc[rows]
+        selection.index = pd.MultiIndex.from_arrays([position[rows]] + [df.index.get_level_values(k)[rows] for k in range(1, df.index.nlevels)],
+                                                    names = [None] + df.index.names[1:])
+        return selection
     else:
-        return df.loc[oversample].reset_index(drop=True)
\ No newline at end of file
+        return df.loc[index].reset_index(drop=True)
\ No newline at end of file
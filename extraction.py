@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+"""
+    Extraction of MIMIC III first day labs and outcomes (see 1. MIMIC - Temporal Lab Extraction.ipynb)
+    LABEVENTS is streamed by chunks and split by range of patients to bound memory
+"""
+import pandas as pd
+import numpy as np
+import shutil
+import os
+
+first_day = pd.to_timedelta('1 day')
+
+def read_mapping(path):
+    """
+        Reads MIMIC_extract labs mapping (ITEMID to variable)
+    """
+    mapping = pd.read_csv(path + 'itemid_to_variable_map.csv', index_col = 'ITEMID', dtype = {'ITEMID': int})
+    mapping = mapping[(mapping['LEVEL2'] != '') &\
+                      (mapping['COUNT'] > 0) &\
+                      (mapping['STATUS'] == 'ready')
+                     ]
+    return mapping
+
+def read_admissions(path):
+    """
+        Reads adults' last admissions with their outcomes (indexed by patient)
+    """
+    genderAge = pd.read_csv(path + 'PATIENTS.csv', usecols = ['SUBJECT_ID', 'GENDER', 'DOB'], parse_dates = ['DOB'])
+    admissions = pd.read_csv(path + 'ADMISSIONS.csv',
+                             usecols = ['SUBJECT_ID', 'HADM_ID', 'ADMISSION_TYPE', 'HOSPITAL_EXPIRE_FLAG',
+                                        'ADMITTIME', 'DISCHTIME', 'DEATHTIME', 'ETHNICITY', 'INSURANCE', 'DIAGNOSIS'],
+                             parse_dates = ['ADMITTIME', 'DISCHTIME', 'DEATHTIME'])
+    admissions = admissions.merge(genderAge, on = 'SUBJECT_ID')
+
+    # Focus only on adults (python dates as shifted dates of birth overflow)
+    removed_nan = admissions[['ADMITTIME', 'DOB']].dropna()
+    admissions['AGE'] = np.nan
+    admissions.loc[removed_nan.index, 'AGE'] = [(admission - birth).days for admission, birth in
+                            zip(removed_nan.ADMITTIME.dt.to_pydatetime(), removed_nan.DOB.dt.to_pydatetime())]
+    admissions.AGE /= 365
+    admissions = admissions[admissions.AGE > 18]
+
+    # Focus on last visits (as space between visit might change process)
+    admissions = admissions.loc[admissions['SUBJECT_ID'].drop_duplicates(keep = 'last').index]
+
+    # Change times to hours since admission
+    admissions['LOS'] = admissions['DISCHTIME'] - admissions['ADMITTIME']
+    admissions['Death'] = admissions['DEATHTIME'] - admissions['ADMITTIME']
+
+    # Shift of 8 hours to have patients of weekend from 8 am on saturday to 8 am on monday
+    admissions['Day'] = (admissions['ADMITTIME'] + pd.to_timedelta('8 hours')).dt.weekday
+
+    admissions = admissions.set_index('SUBJECT_ID')
+    assert len(admissions.HADM_ID.unique()) == len(admissions), \
+        "Different patients have the same HADM_ID, might be a problem for the rest of the code"
+
+    return admissions.rename_axis(index = "Patient")
+
+def stream_labs(path, mapping, admissions, directory, partitions = 10, chunksize = 10**7, labs_all = None):
+    """
+        Streams LABEVENTS: selects labs and admissions of interest and computes time since admission
+        First day observations are appended to one csv per range of patients
+
+        Args:
+            path (str): Path to MIMIC
+            mapping (Dataframe): Labs mapping
+            admissions (Dataframe): Admissions of interest
+            directory (str): Directory for the partitions
+            partitions (int): Number of ranges of patients
+            chunksize (int): Number of rows read at once
+            labs_all (str, optional): Path to save all selected labs (before first day selection)
+    """
+    eligible = np.sort(admissions[admissions.LOS >= first_day].index.values)
+    bounds = [split[0] for split in np.array_split(eligible, partitions)[1:] if len(split)]
+    os.makedirs(directory, exist_ok = True)
+
+    for i, labs in enumerate(pd.read_csv(path + 'LABEVENTS.csv', chunksize = chunksize,
+                                         usecols = ['SUBJECT_ID', 'HADM_ID', 'ITEMID', 'CHARTTIME', 'VALUENUM'])):
+        # Select data and replace itemid with standard format
+        labs = labs[labs.ITEMID.isin(mapping.index) & labs.HADM_ID.isin(admissions.HADM_ID)]
+        labs = labs.assign(Lab = mapping['LEVEL1'].loc[labs['ITEMID']].values,
+                           Time = pd.to_datetime(labs.CHARTTIME).values - admissions.ADMITTIME.loc[labs.SUBJECT_ID].values)
+        labs = labs.rename(columns = {"SUBJECT_ID": "Patient", "VALUENUM": "Value"})[['Patient', 'Time', 'Lab', 'Value']]
+
+        if labs_all is not None:
+            labs.to_csv(labs_all, index = False, mode = 'w' if i == 0 else 'a', header = i == 0)
+
+        # First day - Time in seconds
+        labs = labs[(labs.Time < first_day) & labs.Patient.isin(eligible)]
+        labs = labs.assign(Time = labs.Time.dt.total_seconds())
+        for k, partition in labs.groupby(np.searchsorted(bounds, labs.Patient.values, side = 'right')):
+            file = os.path.join(directory, 'partition_{}.csv'.format(k))
+            partition.to_csv(file, index = False, mode = 'a', header = not os.path.isfile(file))
+
+def pivot_partitions(directory, partitions = 10):
+    """
+        Removes duplicates and pivots each partition
+
+        Returns:
+            Series: Number of patients with more than one observation for each lab
+            int: Total number of patients
+    """
+    counts, patients = None, 0
+    for k in range(partitions):
+        file = os.path.join(directory, 'partition_{}.csv'.format(k))
+        if not os.path.isfile(file):
+            continue
+
+        labs = pd.read_csv(file)
+
+        # Remove duplicates: same test multiple time at the same time
+        labs = labs[~labs.set_index(['Patient', 'Time', 'Lab']).index.duplicated(keep = False)]
+
+        # Pivot to have test as columns
+        labs = labs.pivot(index = ['Patient', 'Time'], columns = 'Lab')
+        labs.to_pickle(os.path.join(directory, 'pivot_{}.pickle'.format(k)))
+
+        count = (labs.groupby('Patient').count() > 1).sum()
+        counts = count if counts is None else counts.add(count, fill_value = 0)
+        patients += labs.index.get_level_values('Patient').nunique()
+
+    return counts.sort_index(), patients
+
+def extract(path, output = 'data/mimic/', partitions = 10, chunksize = 10**7, save_all = False):
+    """
+        Extracts labs_first_day.csv and outcomes_first_day.csv with bounded memory
+
+        Args:
+            path (str): Path to MIMIC
+            output (str): Directory to save the extracted data
+            partitions (int): Number of ranges of patients processed independently
+            chunksize (int): Number of rows of LABEVENTS read at once
+            save_all (bool): Save also labs_all.csv and outcomes_all.csv
+    """
+    directory = os.path.join(output, 'extraction_partitions')
+    shutil.rmtree(directory, ignore_errors = True)
+
+    mapping = read_mapping(path)
+    admissions = read_admissions(path)
+    if save_all:
+        admissions.to_csv(os.path.join(output, 'outcomes_all.csv'))
+
+    stream_labs(path, mapping, admissions, directory, partitions, chunksize,
+                os.path.join(output, 'labs_all.csv') if save_all else None)
+    counts, patients = pivot_partitions(directory, partitions)
+
+    # Keep labs that at least 5% population has one
+    selection = counts.index[(counts / patients) > 0.05]
+
+    last, header = [], True
+    for k in range(partitions):
+        file = os.path.join(directory, 'pivot_{}.pickle'.format(k))
+        if not os.path.isfile(file):
+            continue
+
+        labs = pd.read_pickle(file).reindex(columns = selection)
+
+        # Keep labs only 24 hours after admission
+        labs = labs[labs.index.get_level_values('Time') >= 0]
+
+        # Remove empty lines
+        labs = labs.dropna(how = 'all')
+
+        # Change index to have days
+        labs.index = labs.index.set_levels(labs.index.levels[1] / (3600. * 24), level = 1)
+        labs.to_csv(os.path.join(output, 'labs_first_day.csv'), mode = 'w' if header else 'a', header = header)
+        header = False
+
+        times = labs.index.get_level_values('Time').to_series(index = labs.index.get_level_values('Patient'))
+        last.append(times.groupby('Patient').last())
+    last = pd.concat(last)
+
+    # Remove patients with no labs
+    admissions = admissions.loc[last.index]
+    admissions['LOS'] = admissions['LOS'].dt.total_seconds() / (24 * 60 * 60)
+    admissions['Death'] = admissions['Death'].dt.total_seconds() / (24 * 60 * 60)
+    admissions['Remaining'] = admissions.LOS - last
+    admissions.to_csv(os.path.join(output, 'outcomes_first_day.csv'))
+
+    shutil.rmtree(directory, ignore_errors = True)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description = 'Extracting MIMIC III first day labs.')
+    parser.add_argument('--path', '-p', type = str, required = True, help = 'Path to MIMIC III csv files (and itemid_to_variable_map.csv).')
+    parser.add_argument('--output', '-o', type = str, default = 'data/mimic/', help = 'Directory to save the extracted data.')
+    parser.add_argument('--partitions', type = int, default = 10, help = 'Number of ranges of patients processed independently.')
+    parser.add_argument('--chunksize', type = int, default = 10**7, help = 'Number of rows of LABEVENTS read at once.')
+    parser.add_argument('--all', action = 'store_true', help = 'Save also labs_all.csv and outcomes_all.csv.')
+    args = parser.parse_args()
+
+    extract(args.path, args.output, args.partitions, args.chunksize, args.all)
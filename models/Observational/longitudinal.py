@@ -1,4 +1,5 @@
 from ..utils import *
+from functools import partial
 import torch.nn as nn
 import torch
 
@@ -7,13 +8,13 @@ class Longitudinal():
         Factory object
     """
     @staticmethod
-    def create(longitudinal, inputdim, outputdim, longitudinal_args = {}): 
+    def create(longitudinal, inputdim, outputdim, longitudinal_args = {}, components = 1): 
         if longitudinal == 'None':
             return None
         elif longitudinal == 'neural':
-            return Neural(inputdim, outputdim, longitudinal_args)
+            return Neural(inputdim, outputdim, longitudinal_args, components)
         elif longitudinal == 'gaussian':
-            return Gaussian(inputdim, outputdim, longitudinal_args)
+            return Gaussian(inputdim, outputdim, longitudinal_args, components)
         else:
             raise NotImplementedError()
 
@@ -22,41 +23,62 @@ class Neural(BatchForward):
     """
         Neural with Gaussian error
     """
+    output_dim = 1 # Outputs: components first
 
-    def __init__(self, inputdim, outputdim, longitudinal_args = {}):
+    def __init__(self, inputdim, outputdim, longitudinal_args = {}, components = 1):
         """
         Args:
             inputdim (int): Input dimension (hidden state)
             outputdim (int): Output dimension (original input dimension)
             longitudinal_args (dict, optional): Arguments for the model. Defaults to {}.
+            components (int, optional): Number of components (mixture) evaluated at once. Defaults to 1.
         """
         super(Neural, self).__init__()
 
         self.inputdim = inputdim
         self.outputdim = outputdim
+        self.components = components
 
         longitudinal_layer = longitudinal_args['layers'] if 'layers' in longitudinal_args else [100]
-        self.mean_var = nn.Sequential(*create_nn(inputdim + 1, longitudinal_layer + [2 * outputdim])[:-1])
+        self.mean_var = nn.Sequential(*create_nn(inputdim + 1, longitudinal_layer + [2 * outputdim], partial(StackedLinear, components))[:-1])
         self.softplus = nn.Softplus()
 
     def forward_batch(self, h, i, m, l):
         tau = i[:, 1:].unsqueeze(-1)
         h_time = h[:, :-1, :]  # Last point not observed
-        concat = torch.cat((h_time, tau), 2)
+        layers = list(self.mean_var)
 
-        mean_var = self.mean_var(concat)
-        mean, var = mean_var[:,:,:self.outputdim], self.softplus(mean_var[:,:,self.outputdim:])
+        # First layer: hidden state part shared by tau and zero (and by the components)
+        first = layers[0]
+        hidden_0 = stacked_linear(h_time.expand((self.components,) + h_time.shape), first.weight[:, :, :-1], first.bias)
+        hidden = add_last_input(hidden_0, tau, first.weight)
 
-        concat = torch.cat((h_time, torch.zeros_like(tau)), 2)
-        mean_0 = self.mean_var(concat)[:,:,:self.outputdim]
+        if len(layers) == 1:
+            mean_var, mean_0 = hidden, hidden_0[..., :self.outputdim]
+        else:
+            for layer in layers[1:-1]:
+                hidden, hidden_0 = layer(hidden), layer(hidden_0)
+            # Only the mean is needed at zero
+            last = layers[-1]
+            mean_var = last(hidden)
+            mean_0 = stacked_linear(hidden_0, last.weight[:, :self.outputdim], last.bias[:, :self.outputdim])
+        mean, var = mean_var[..., :self.outputdim], self.softplus(mean_var[..., self.outputdim:])
 
         return mean - mean_0, var
 
     def loss(self, alpha, h, x, i, m, l, batch = None, reduction = 'mean'):
-        mean, variance = self.forward(h, i, m, l, batch = batch)
+        return self.likelihood(alpha, self.forward(h, i, m, l, batch = batch), x, m, l, reduction)
+
+    def likelihood(self, alpha, outputs, x, m, l, reduction = 'mean'):
+        """
+            Loss given the outputs of forward
+            (alpha and outputs can have leading dimensions, e.g. one per component: summed)
+        """
+        mean, variance = outputs
         submask = m[:, 1:, :] # First value not even predicted for each time series
         diff = x[:, 1:, :] - x[:, :-1, :]
-        loss = (alpha[submask] * nn.GaussianNLLLoss(reduction = "none", full = True)(mean[submask], diff[submask], variance[submask])).sum()
+        mean, variance = mean[..., submask], variance[..., submask]
+        loss = (alpha[..., submask] * nn.GaussianNLLLoss(reduction = "none", full = True)(mean, diff[submask].expand_as(mean), variance)).sum()
 
         if reduction == 'mean':
             loss /= submask.sum()
@@ -69,25 +91,24 @@ class Gaussian(Neural):
         Gaussian function of time
     """
 
-    def __init__(self, inputdim, outputdim, longitudinal_args = {}):
+    def __init__(self, inputdim, outputdim, longitudinal_args = {}, components = 1):
         """
         Args:
             inputdim (int): Input dimension (hidden state)
             outputdim (int): Output dimension (original input dimension)
             longitudinal_args (dict, optional): Arguments for the model. Defaults to {}.
+            components (int, optional): Number of components (mixture) evaluated at once. Defaults to 1.
         """
-        super(Gaussian, self).__init__(inputdim, outputdim, longitudinal_args)
+        super(Gaussian, self).__init__(inputdim, outputdim, longitudinal_args, components)
         representation = longitudinal_args['representation'] if 'representation' in longitudinal_args else 50
-        self.mean_var = nn.Linear(representation + 1, 2 * outputdim)
-        self.latent = nn.Parameter(torch.randn(1, 1, representation))
+        self.mean_var = StackedLinear(components, representation + 1, 2 * outputdim)
+        self.latent = nn.Parameter(torch.randn(components, 1, 1, representation))
 
     def forward_batch(self, h, i, m, l):
         tau = i[:, 1:].unsqueeze(-1)
-        centroid = torch.cat((self.latent.repeat((len(h), tau.shape[1], 1)), tau), 2)
-        mean_var = self.mean_var(centroid)
-        mean, var = mean_var[:,:,:self.outputdim], self.softplus(mean_var[:,:,self.outputdim:])
-
-        centroid = torch.cat((self.latent.repeat((len(h), tau.shape[1], 1)), torch.zeros_like(tau)), 2)
-        mean_0 = self.mean_var(centroid)[:,:,:self.outputdim]
+        # Latent shared by all points: linear in tau (mean at zero cancels its part)
+        weight = self.mean_var.weight
+        mean_var = add_last_input(stacked_linear(self.latent, weight[:, :, :-1], self.mean_var.bias), tau, weight)
+        mean, var = tau * weight[:, None, None, :self.outputdim, -1], self.softplus(mean_var[..., self.outputdim:])
 
-        return mean - mean_0, var
\ No newline at end of file
+        return mean, var
\ No newline at end of file
@@ -1,4 +1,5 @@
 from ..utils import *
+from functools import partial
 import torch.nn as nn
 import torch
 
@@ -7,13 +8,13 @@ class Missing():
         Factory object
     """
     @staticmethod
-    def create(missing, inputdim, outputdim, missing_args = {}): 
+    def create(missing, inputdim, outputdim, missing_args = {}, components = 1): 
         if missing == 'None':
             return None
         elif missing == 'neural':
-            return Neural(inputdim, outputdim, missing_args)
+            return Neural(inputdim, outputdim, missing_args, components)
         elif missing == 'bernoulli':
-            return Bernoulli(inputdim, outputdim, missing_args)
+            return Bernoulli(inputdim, outputdim, missing_args, components)
         else:
             raise NotImplementedError()
 
@@ -22,34 +23,47 @@ class Neural(BatchForward):
     """
         Neural with BCE error
     """
+    output_dim = 1 # Outputs: components first
 
-    def __init__(self, inputdim, outputdim, missing_args = {}):
+    def __init__(self, inputdim, outputdim, missing_args = {}, components = 1):
         """
         Args:
             inputdim (int): Input dimension (hidden state)
             outputdim (int): Output dimension (original input dimension)
             missing_args (dict, optional): Arguments for the model. Defaults to {}.
+            components (int, optional): Number of components (mixture) evaluated at once. Defaults to 1.
         """
         super(Neural, self).__init__()
 
         self.inputdim = inputdim
         self.outputdim = outputdim
+        self.components = components
 
         missing_layer = missing_args['layers'] if 'layers' in missing_args else [100]
-        self.missing = nn.Sequential(*create_nn(inputdim + 1, missing_layer + [outputdim])[:-1], nn.Sigmoid()) # Time might be informative : + 1
+        self.missing = nn.Sequential(*create_nn(inputdim + 1, missing_layer + [outputdim], partial(StackedLinear, components))[:-1], nn.Sigmoid()) # Time might be informative : + 1
 
     def forward_batch(self, h, i, m, l):
         tau = i[:, 1:].unsqueeze(-1)
         h_time = h[:, :-1, :]  # Last point not observed
-        h_time = torch.cat((h_time, tau), 2)
-        return self.missing(h_time),
+        # First layer: hidden state shared by the components (concatenation with tau not materialized)
+        first = self.missing[0]
+        hidden = add_last_input(stacked_linear(h_time.expand((self.components,) + h_time.shape), first.weight[:, :, :-1], first.bias), tau, first.weight)
+        return self.missing[1:](hidden),
 
     def loss(self, alpha, h, i, m, l, batch = None, reduction = 'mean'):
-        predictions, = self.forward(h, i, m, l, batch = batch)
+        return self.likelihood(alpha, self.forward(h, i, m, l, batch = batch), m, l, reduction)
+
+    def likelihood(self, alpha, outputs, m, l, reduction = 'mean'):
+        """
+            Loss given the outputs of forward
+            (alpha and outputs can have leading dimensions, e.g. one per component: summed)
+        """
+        predictions, = outputs
         submask = m[:, 1:, :] # First value not even predicted for each time series
         # Ignore all steps where nothing is observed adn therefore prediction on nothing
         observed = torch.max(submask, dim = 2)[0]
-        loss = (alpha[observed].flatten() * nn.BCELoss(reduction = "none")(predictions[observed].flatten(), submask[observed].flatten().double())).sum()
+        predictions = predictions[..., observed, :]
+        loss = (alpha[..., observed, :] * nn.BCELoss(reduction = "none")(predictions, submask[observed].to(predictions.dtype).expand_as(predictions))).sum()
 
         if reduction == 'mean':
             loss /= submask[observed].sum()
@@ -61,19 +75,21 @@ class Bernoulli(Neural):
         Bernoulli function of time
     """
 
-    def __init__(self, inputdim, outputdim, missing_args = {}):
+    def __init__(self, inputdim, outputdim, missing_args = {}, components = 1):
         """
         Args:
             inputdim (int): Input dimension (hidden state)
             outputdim (int): Output dimension (original input dimension)
             missing_args (dict, optional): Arguments for the model. Defaults to {}.
+            components (int, optional): Number of components (mixture) evaluated at once. Defaults to 1.
         """
-        super(Bernoulli, self).__init__(inputdim, outputdim, missing_args)
+        super(Bernoulli, self).__init__(inputdim, outputdim, missing_args, components)
         representation = missing_args['representation'] if 'representation' in missing_args else 50
-        self.latent = nn.Parameter(torch.randn(1, 1, representation))
-        self.missing = nn.Sequential(nn.Linear(representation + 1, outputdim), nn.Sigmoid())
+        self.latent = nn.Parameter(torch.randn(components, 1, 1, representation))
+        self.missing = nn.Sequential(StackedLinear(components, representation + 1, outputdim), nn.Sigmoid())
 
     def forward_batch(self, h, i, m, l):
         tau = i[:, 1:].unsqueeze(-1)
-        centroid = torch.cat((self.latent.repeat((len(h), tau.shape[1], 1)), tau), 2)
-        return self.missing(centroid),
\ No newline at end of file
+        # Latent shared by all points (broadcasted)
+        first = self.missing[0]
+        return self.missing[1:](add_last_input(stacked_linear(self.latent, first.weight[:, :, :-1], first.bias), tau, first.weight)),
\ No newline at end of file
@@ -1,5 +1,5 @@
 from ..utils import *
-from torch.autograd import grad
+from functools import partial
 import torch.nn as nn
 import torch
 
@@ -8,13 +8,13 @@ class Temporal():
         Factory object
     """
     @staticmethod
-    def create(temporal, inputdim, outputdim, temporal_args = {}): 
+    def create(temporal, inputdim, outputdim, temporal_args = {}, components = 1): 
         if temporal == 'None':
             return None
         elif temporal == 'point':
-            return Point(inputdim, outputdim, temporal_args)
+            return Point(inputdim, outputdim, temporal_args, components)
         elif temporal == 'weibull':
-            return Weibull(inputdim, outputdim, temporal_args)
+            return Weibull(inputdim, outputdim, temporal_args, components)
         else:
             raise NotImplementedError()
 
@@ -23,8 +23,9 @@ class Weibull(BatchForward):
     """
         Weibull distribution
     """
+    output_dim = 1 # Outputs: components first
 
-    def __init__(self, inputdim, outputdim, temporal_args = {}):
+    def __init__(self, inputdim, outputdim, temporal_args = {}, components = 1):
         """
         Args:
             temporal (str, optional): Type of temporal modelling. (When will be the next values ?)
@@ -33,12 +34,13 @@ class Weibull(BatchForward):
             inputdim (int): Input dimension (hidden state)
             outputdim (int): Output dimension (original data size)
             temporal_args (dict, optional): Arguments for the model. Defaults to {}.
+            components (int, optional): Number of components (mixture) evaluated at once. Defaults to 1.
         """
         super(Weibull, self).__init__()
 
-        # Only one Weibull
-        self.shape = nn.Parameter(-torch.randn(1)) # k = exp(shape) 
-        self.scale = nn.Parameter(-torch.randn(1)) # b = exp(scale)
+        # Only one Weibull by component
+        self.shape = nn.Parameter(-torch.randn(components, 1)) # k = exp(shape) 
+        self.scale = nn.Parameter(-torch.randn(components, 1)) # b = exp(scale)
 
     def forward_batch(self, h, i, m, l):
         sh, sc = self.shape, self.scale
@@ -47,12 +49,20 @@ class Weibull(BatchForward):
         density_log = sc + sh + (torch.exp(sh) - 1) * (torch.log(i_used) + sc) \
                 + survival_log
 
-        return torch.exp(survival_log).reshape([h.shape[0], h.shape[1] - 1]), density_log.reshape([h.shape[0], h.shape[1] - 1])
+        shape = [len(sh), h.shape[0], h.shape[1] - 1]
+        return torch.exp(survival_log).reshape(shape), density_log.reshape(shape)
 
     def loss(self, alpha, h, i, m, l, batch = None, reduction = 'mean'):
-        _, density = self.forward(h, i, m, l, batch = batch)
+        return self.likelihood(alpha, self.forward(h, i, m, l, batch = batch), m, l, reduction)
+
+    def likelihood(self, alpha, outputs, m, l, reduction = 'mean'):
+        """
+            Loss given the outputs of forward
+            (alpha and outputs can have leading dimensions, e.g. one per component: summed)
+        """
+        _, density = outputs
         observed = torch.max(m[:, 1:, :], dim = 2)[0]
-        loss = - ((alpha * density)[observed]).sum() 
+        loss = - ((alpha * density)[..., observed]).sum() 
 
         if reduction == 'mean':
             loss /= torch.sum(l - 1)
@@ -60,8 +70,9 @@ class Weibull(BatchForward):
 
 
 class Point(BatchForward):
+    output_dim = 1 # Outputs: components first
 
-    def __init__(self, inputdim, outputdim, temporal_args = {}):
+    def __init__(self, inputdim, outputdim, temporal_args = {}, components = 1):
         """
         Args:
             temporal (str, optional): Type of temporal modelling. (When will be the next values ?)
@@ -70,14 +81,16 @@ class Point(BatchForward):
             inputdim (int): Input dimension (hidden state)
             outputdim (int): Output dimension (original data size)
             temporal_args (dict, optional): Arguments for the model. Defaults to {}.
+            components (int, optional): Number of components (mixture) evaluated at once. Defaults to 1.
         """
         super(Point, self).__init__()
 
         self.inputdim = inputdim
         self.outputdim = outputdim
+        self.components = components
 
         temporal_layer = temporal_args['layers'] if 'layers' in temporal_args else [100]
-        self.cumulative = nn.Sequential(*create_nn(inputdim + 1, temporal_layer + [outputdim], PositiveLinear, 'Tanh')[:-1], nn.Softplus())
+        self.cumulative = nn.Sequential(*create_nn(inputdim + 1, temporal_layer + [outputdim], partial(PositiveStackedLinear, components), 'Tanh')[:-1], nn.Softplus())
 
     def forward_batch(self, h, i, m, l):
         tau = i[:, 1:].unsqueeze(-1)
@@ -87,27 +100,58 @@ class Point(BatchForward):
         tau = torch.flatten(tau, 0, 1) 
         hidden_tau = torch.flatten(hidden_tau, 0, 1)
 
-        tau.requires_grad = True # For autograd
-        cumulative = self.cumulative(torch.cat((hidden_tau, tau), 1)) - self.cumulative(torch.cat((hidden_tau, torch.zeros_like(tau)), 1))
-        cumulative = cumulative.reshape([h.shape[0], h.shape[1] - 1])
-        gradient = grad(torch.mean(cumulative), tau, create_graph=True, retain_graph=True)[0].reshape([h.shape[0], h.shape[1] - 1])
+        # First layer: hidden state part shared by tau and zero (and by the components)
+        first = self.cumulative[0]
+        weight = first.weights
+        zero = stacked_linear(hidden_tau.expand(self.components, -1, -1), weight[:, :, :-1], first.bias)
+        output = add_last_input(zero, tau, weight)
+
+        # Derivative with regard to tau propagated alongside (chain rule - no second order backward)
+        gradient = weight[:, :, -1].unsqueeze(1).expand(-1, len(tau), -1)
+        for layer in self.cumulative[1:]:
+            output, gradient = self.chain(layer, output, gradient)
+            zero = layer(zero)
 
-        if h.is_cuda:
-            gradient = gradient.cuda()
+        shape = [self.components, h.shape[0], h.shape[1] - 1]
+        cumulative = (output - zero).reshape(shape)
+        gradient = gradient.reshape(shape) / cumulative[0].numel() # Scale of the gradient of the mean
 
         survival = torch.exp(-cumulative)
         return survival, gradient, cumulative
 
+    @staticmethod
+    def chain(layer, x, dx):
+        """
+            Output of the layer and its derivative given dx the derivative of x
+        """
+        y = layer(x)
+        if isinstance(layer, StackedLinear):
+            dy = stacked_linear(dx, layer.weights)
+        elif isinstance(layer, nn.Tanh):
+            dy = torch.ops.aten.tanh_backward(dx, y)
+        elif isinstance(layer, nn.Softplus):
+            dy = torch.ops.aten.softplus_backward(dx, x, layer.beta, layer.threshold)
+        else:
+            raise NotImplementedError()
+        return y, dy
+
     def loss(self, alpha, h, i, m, l, batch = None, reduction = 'mean'):
-        _, gradient, cumulative = self.forward(h, i, m, l, batch = batch)
+        return self.likelihood(alpha, self.forward(h, i, m, l, batch = batch), m, l, reduction)
+
+    def likelihood(self, alpha, outputs, m, l, reduction = 'mean'):
+        """
+            Loss given the outputs of forward
+            (alpha and outputs can have leading dimensions, e.g. one per component: summed)
+        """
+        _, gradient, cumulative = outputs
         observed = torch.max(m[:, 1:, :], dim = 2)[0]
 
         with torch.no_grad():
             gradient.clamp_(min = 1e-8)
 
         # TODO: exact loss, not ELBO
-        loss = torch.add(torch.sum((alpha * cumulative)[observed]),
-                        -torch.sum((alpha * torch.log(gradient))[observed]))
+        loss = torch.add(torch.sum((alpha * cumulative)[..., observed]),
+                        -torch.sum((alpha * torch.log(gradient))[..., observed]))
 
         if reduction == 'mean':
             loss /= torch.sum(l - 1)
@@ -1,7 +1,61 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from torch.nn.utils.rnn import PackedSequence
 from torch.nn.modules.rnn import RNNCellBase
+from functools import lru_cache
+from typing import List, Optional
+
+@lru_cache(maxsize = None)
+def scripted(function):
+    """
+        TorchScript version of function (compiled once, at first use)
+    """
+    return torch.jit.script(function)
+
+def grud_step(gi, decay, hidden, w_hh, b_hh: Optional[torch.Tensor]):
+    """
+    Args:
+        gi (Tensor): Projection of the new data (input doors)
+        decay (Tensor): Decay of the hidden state since last observation
+        hidden (Tensor): Hidden state from previous time
+        w_hh (Tensor): Hidden weights
+        b_hh (Tensor): Hidden bias (None if no bias)
+
+    Returns:
+        Tensor: New hidden state
+    """
+    # Decayed hidden state
+    hidden = hidden * decay
+
+    # Doors
+    gh = F.linear(hidden, w_hh, b_hh)
+
+    i_r, i_i, i_n = gi.chunk(3, 1)
+    h_r, h_i, h_n = gh.chunk(3, 1)
+
+    resetgate = torch.sigmoid(i_r + h_r)
+    inputgate = torch.sigmoid(i_i + h_i)
+    newgate = torch.tanh(i_n + resetgate * h_n)
+    return newgate + inputgate * (hidden - newgate)
+
+def grud_recurrence(x, times, hidden, w_ih, w_hh, b_ih: Optional[torch.Tensor], b_hh: Optional[torch.Tensor],
+                    w_decay, b_decay, dropout: float, training: bool) -> List[torch.Tensor]:
+    """
+        Hidden states at all time steps
+        Input doors and decays do not depend on the hidden state: computed for all steps at once
+    """
+    gi = F.linear(x, w_ih, b_ih)
+    decay = torch.exp(- (times.unsqueeze(-1) * w_decay.t() + b_decay).clamp_(0, 1000)) # Limit values (one time dimension)
+
+    # Unbind: one gradient copy for all steps (not one by step slice)
+    outputs = []
+    for gi_i, decay_i in zip(gi.unbind(1), decay.unbind(1)):
+        hidden = grud_step(gi_i, decay_i, hidden, w_hh, b_hh)
+        if dropout > 0:
+            hidden = F.dropout(hidden, dropout, training)
+        outputs.append(hidden)
+    return outputs
 
 class GRUDCell(RNNCellBase):
     """
@@ -25,49 +79,25 @@ class GRUDCell(RNNCellBase):
             x (Tensor): New data
             time (Tensor): Time difference since last observation
             hidden (Tensor): Hidden state from previous time
-            w_ih ([type]): [description]
-            w_hh ([type]): [description]
-            b_ih ([type]): [description]
-            b_hh ([type]): [description]
+            w_ih (Tensor): Input weights
+            w_hh (Tensor): Hidden weights
+            b_ih (Tensor): Input bias
+            b_hh (Tensor): Hidden bias
 
         Returns:
-            [type]: [description]
+            Tensor: New hidden state
         """
         # Compute decay (limit values)
-        decay = torch.exp( - torch.min(
-                                torch.max(
-                                    torch.zeros(size=(self.hidden_size,), device = x.get_device() if x.is_cuda else 'cpu'),
-                                    self.decay(time)
-                                ), 
-                                torch.ones(size=(self.hidden_size,), device = x.get_device() if x.is_cuda else 'cpu') * 1000 
-                            )
-                         )
-
-        # Decayed hidden state
-        hidden = hidden * decay
-
-        # Doors 
-        gi = torch.mm(x, w_ih.t())
-        gh = torch.mm(hidden, w_hh.t())
-        
-        if self.bias:
-            gi += b_ih
-            gh += b_hh
-        
-        i_r, i_i, i_n = gi.chunk(3, 1)
-        h_r, h_i, h_n = gh.chunk(3, 1)
-
-        resetgate = torch.sigmoid(i_r + h_r)
-        inputgate = torch.sigmoid(i_i + h_i)
-        newgate = torch.tanh(i_n + resetgate * h_n)
-        hy = newgate + inputgate * (hidden - newgate)
+        decay = torch.exp(- self.decay(time).clamp_(0, 1000))
+
+        hy = grud_step(F.linear(x, w_ih, b_ih), decay, hidden, w_hh, b_hh)
         return hy if self.dropout is None else self.dropout(hy)
 
     def forward(self, x, t, hx = None):
         if hx is None:
-            hx = torch.zeros(x.size(0), self.hidden_size, 
+            hx = torch.zeros(x.size(0), self.hidden_size,
                 dtype=x.dtype, device = x.get_device() if x.is_cuda else 'cpu')
-                
+
         return self.gru_exp_decay_cell(
             x, t, hx,
             self.weight_ih, self.weight_hh,
@@ -75,14 +105,25 @@ class GRUDCell(RNNCellBase):
         )
 
 class GRUD(nn.Module):
-    
-    def __init__(self, inputdim, hidden, layers, bias=True, batch_first=True, imputation=False, dropout = 0):
+
+    def __init__(self, inputdim, hidden, layers, bias=True, batch_first=True, imputation=False, dropout = 0, script = False):
         super(GRUD, self).__init__()
         self.cell = GRUDCell(inputdim, 1, hidden, bias, dropout) # Only time since last (put inputdim if all modelled)
         self.num_layers = layers
         self.hidden_size = hidden
         self.batch_first = batch_first
         self.imputation = imputation
+        self.script = script # Compile the recurrence with TorchScript
+
+    def recurrence(self, input, times, hx):
+        """
+            Hidden states at all given time steps (list)
+        """
+        recurrence = scripted(grud_recurrence) if self.script else grud_recurrence
+        return recurrence(input, times, hx,
+            self.cell.weight_ih, self.cell.weight_hh, self.cell.bias_ih, self.cell.bias_hh,
+            self.cell.decay[0].weight, self.cell.decay[0].bias,
+            0. if self.cell.dropout is None else self.cell.dropout.p, self.cell.training)
 
     def forward(self, input, times, mask, length, hx = None):
         # Does not deal with Packed as it seems they have strange behavior
@@ -98,25 +139,14 @@ class GRUD(nn.Module):
             hx = torch.zeros(max_batch_size, self.hidden_size,
                              dtype=input.dtype, device = input.get_device() if input.is_cuda else 'cpu')
 
-        outputs = None
-        for i in range(max_time):           
-            # TODO: adapt to do batch_first = False and to have same format than GRU (with packed)
-            hx = self.cell.forward(torch.squeeze(input[:,i:i+1,:]),
-                    times[:,i:i+1],
-                    hx)
-
-            if outputs is None:
-                outputs = hx.unsqueeze(1)
-            else:
-                outputs = torch.cat((outputs, hx.unsqueeze(1)), 1)
-
-        empty = torch.zeros(max_batch_size, 1, self.hidden_size, dtype=input.dtype, device=input.get_device() if input.is_cuda else 'cpu')
-        for i in range(max_time, input.size(1)): 
-            outputs = torch.cat((outputs, empty), 1)
-        
-        # Remove last steps that are unecessary
-        end = outputs[0, length[0].long() - 1, :].unsqueeze(0)
-        for i in range(1, input.size()[0]):
-            end = torch.cat((end, outputs[i, length[i].long() - 1, :].unsqueeze(0)), 0)
-
-        return outputs, (end, None)
\ No newline at end of file
+        # TODO: adapt to do batch_first = False and to have same format than GRU (with packed)
+        outputs = self.recurrence(input[:, :max_time], times[:, :max_time], hx)
+
+        # Padding after the longest time series and one copy of all states
+        outputs += [torch.zeros_like(hx)] * (input.size(1) - max_time)
+        outputs = torch.stack(outputs, 1)
+
+        # Last observed states
+        end = outputs[torch.arange(max_batch_size, device = outputs.device), length.long() - 1]
+
+        return outputs, (end, None)
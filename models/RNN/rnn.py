@@ -69,7 +69,6 @@ class RNN(BatchForward):
         # To handle different size time series
         if self.time:
             hidden, (hp, c) = self.embedding(x, t, m, l) 
-            hp = get_last_observed(hidden, l - 1)
         else:
             pack = torch.nn.utils.rnn.pack_padded_sequence(x,
                                            l.cpu(),
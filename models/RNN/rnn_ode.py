@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+import math
 from .grud import *
 class ODESolver(nn.Module):
     """
@@ -29,6 +30,9 @@ class ODESolver(nn.Module):
         """
         # Decode the trajectory through ODE Solver
         """
+        if self.method == 'euler':
+            return self.euler(x, t)
+
         from torchdiffeq import odeint as odeint
         time_eval, indices = self.split_time(t)
         
@@ -40,6 +44,19 @@ class ODESolver(nn.Module):
         
         return torch.gather(pred_y, 2, indices).squeeze()
 
+    def euler(self, x, t):
+        """
+            Fixed step Euler evolution of all patients at once (each row during its own time t)
+            Last step is shortened to end at t, rows that reached their time are not evaluated anymore
+        """
+        t = t.reshape(-1, 1)
+        steps = math.ceil(max(t.max().item(), 0) / self.step_size)
+        for k in range(steps):
+            active = (t[:, 0] > k * self.step_size).nonzero().squeeze(1)
+            dt = (t[active] - k * self.step_size).clamp(max = self.step_size)
+            x = x.index_add(0, active, dt * self.ode_func(k * self.step_size, x[active]))
+        return x
+
     def split_time(self, t):
         # Compute where we need to estimate hidden state
         res, index = torch.unique(t, sorted=True, return_inverse=True)
@@ -57,10 +74,10 @@ class ODECell(RNNCellBase):
         Cell with decay between time points
     """
 
-    def __init__(self, input_size, hidden_size, bias=True, step_size = 1.0, dropout = 0):
+    def __init__(self, input_size, hidden_size, bias=True, step_size = 1.0, dropout = 0, method = "euler"):
         super(ODECell, self).__init__(input_size, hidden_size, bias, num_chunks = 3)
         self.cell = nn.GRUCell(input_size = input_size, hidden_size = hidden_size, bias = bias)
-        self.ode = ODESolver("euler", hidden_size, 
+        self.ode = ODESolver(method, hidden_size, 
                         odeint_rtol = 1e-3, odeint_atol = 1e-4, step_size = step_size)
 
         if dropout > 0:
@@ -79,6 +96,13 @@ class ODECell(RNNCellBase):
 
 class ODE(GRUD):
     
-    def __init__(self, inputdim, hidden, layers, bias=True, batch_first=True):
+    def __init__(self, inputdim, hidden, layers, bias=True, batch_first=True, step_size = 1.0, method = "euler"):
         super(ODE, self).__init__(inputdim, hidden, layers, bias)
-        self.cell = ODECell(inputdim, hidden, bias)
\ No newline at end of file
+        self.cell = ODECell(inputdim, hidden, bias, step_size, method = method)
+
+    def recurrence(self, input, times, hx):
+        outputs = []
+        for i in range(input.size(1)):
+            hx = self.cell.forward(input[:, i], times[:, i:i+1], hx)
+            outputs.append(hx)
+        return outputs
\ No newline at end of file
@@ -35,6 +35,7 @@ class DeepSurv(BatchForward):
 
         self.inputdim = inputdim
         self.outputdim = outputdim
+        self.horizons = {} # Baselines at the predicted horizons
 
         survival_layer = survival_args['layers'] if 'layers' in survival_args else [100]
         
@@ -47,66 +48,93 @@ class DeepSurv(BatchForward):
         outcome = torch.cat(outcome, -1)
         return outcome,
 
-    def loss(self, h, e, batch = None, reduction = 'mean'):
-        loss, e = 0, e.squeeze()
+    def loss(self, h, e, t = None, batch = None, reduction = 'mean'):
+        """
+            Cox partial likelihood of all risks in one pass (Breslow handling of ties)
+            Risk sets are computed from t, the batch can be in any order
+            Without t, the batch is assumed ordered by decreasing time
+        """
+        e = e.reshape(-1).long()
         predictions, = self.forward(h, batch = batch)
+        predictions = predictions.double() # Cumulative sums in float64 whatever the network precision
+
+        if t is None:
+            ## Sum all previous event : **Require order by decreasing time**
+            p_cumsum = torch.logcumsumexp(predictions, 0)
+        else:
+            # Sum over all patients with a time larger or equal (ties included)
+            t = t.reshape(-1).contiguous() # Batches can be strided views (see packed)
+            t_sorted, order = torch.sort(t)
+            p_cumsum = torch.logcumsumexp(predictions[order].flip(0), 0).flip(0)
+            p_cumsum = p_cumsum[torch.searchsorted(t_sorted, t, side = 'left')]
 
-        ## Sum all previous event : **Require order by decreasing time**
-        p_cumsum = torch.logcumsumexp(predictions, 0)
-        for ei in range(1, self.outputdim + 1):
-            loss -= torch.sum(predictions[e == ei][:, ei - 1])
-            loss += torch.sum(p_cumsum[e == ei][:, ei - 1])
+        # Select the risk observed for each patient (censored patients are masked)
+        events = e > 0
+        risks = (e - 1).clamp(min = 0).unsqueeze(1)
+        loss = torch.sum((p_cumsum - predictions).gather(1, risks).squeeze(1) * events)
 
-        if reduction == 'mean' and (e != 0).sum() > 0:
-            loss /= (e != 0).sum()
+        if reduction == 'mean' and events.any():
+            loss = loss / events.sum()
 
         return loss
 
-    def compute_baseline(self, h, e, t, batch = None):
+    @torch.no_grad()
+    def compute_baseline(self, h, e, t, batch = None, weights = None):
         # Breslow estimator
         # At time of the event, the cumulative proba is one
-        predictions = torch.exp(self.forward(h, batch = batch)[0])
+        # Weights: Number of times each patient is counted (oversampling)
+        predictions = torch.exp(self.forward(h, batch = batch)[0].double())
+        if weights is None:
+            weights = torch.ones(len(e), dtype = predictions.dtype, device = predictions.device)
+        else:
+            # Patients never sampled are not in the data (their times neither)
+            weights = weights.to(predictions)
+            sampled = weights > 0
+            predictions, weights, e, t = predictions[sampled], weights[sampled], e[sampled.to(e.device)], t[sampled.to(t.device)]
+        predictions = predictions * weights.unsqueeze(1)
 
         # Remove duplicates and order
-        self.baselines = []
+        self.horizons = {}
         self.times, indices = torch.unique(t.squeeze(), return_inverse = True, sorted = True)
-        for risk in range(1, self.outputdim + 1):
-            e_summed, p_summed = [], []
-            for i, _ in enumerate(self.times):
-                # Descending order
-                e_summed.insert(0, (e[indices == i] == risk).sum())
-                p_summed.insert(0, predictions[indices == i][:, risk - 1].sum()) # -1 because only one dimension for each risk (no 0 modelling)
-
-            e_summed, p_summed = torch.DoubleTensor(e_summed), \
-                                torch.DoubleTensor(p_summed)
-            p_summed = torch.cumsum(p_summed, 0) # Number patients
-            
-            # Reverse order
-            self.baselines.append(torch.cumsum((e_summed / p_summed)[torch.arange(len(self.times), 0, -1) - 1], 0).unsqueeze(0))
-        self.baselines = torch.cat(self.baselines, 0)
+        indices, e = indices.reshape(-1), e.reshape(-1).long()
+
+        # Sum weighted events (0 for censored) and predictions for each time (all risks at once)
+        e_summed = torch.zeros((len(self.times), self.outputdim + 1), dtype = predictions.dtype, device = predictions.device)
+        e_summed = e_summed.index_put_((indices, e), weights, accumulate = True)[:, 1:]
+        p_summed = torch.zeros((len(self.times), self.outputdim), dtype = predictions.dtype, device = predictions.device)
+        p_summed = p_summed.index_add_(0, indices, predictions)
+
+        # Number patients at risk: reversed cumulative sum (from the last time)
+        p_summed = torch.cumsum(p_summed.flip(0), 0).flip(0)
+        self.baselines = torch.cumsum(e_summed / p_summed, 0).T.contiguous().cpu()
         return self
 
+    def horizon_baselines(self, horizon):
+        """
+            Cumulative baseline hazards at the last training time before each horizon (0 before the first one)
+            Located once by horizons and cached until the next baseline estimation
+        """
+        key = tuple(horizon)
+        if key not in self.horizons:
+            index = torch.searchsorted(self.times.cpu(), torch.tensor(horizon, dtype = self.times.dtype), right = True) - 1
+            baselines = self.baselines.cpu()[:, index.clamp(min = 0)]
+            self.horizons[key] = torch.where(index >= 0, baselines, torch.zeros_like(baselines))
+        return self.horizons[key]
+
     def predict_batch(self, h, horizon, risk = 1):
         forward, = self.forward_batch(h)
-        cumulative_hazard = self.baselines[risk - 1].unsqueeze(0)
-        if h.is_cuda:
-            cumulative_hazard = cumulative_hazard.cuda()
+        forward = forward.double() # Baseline in float64
+
+        if isinstance(horizon, list):
+            # Only the horizons of interest
+            cumulative_hazard = self.horizon_baselines(horizon)[risk - 1].unsqueeze(0)
+        else:
+            cumulative_hazard = self.baselines[risk - 1].unsqueeze(0)
+        cumulative_hazard = cumulative_hazard.to(forward.device)
 
         # exp(W X) * Cum_intensity = Cumulative hazard at time t
         # Survival = exp(-cum hazard) 
         predictions = torch.exp(- torch.matmul(torch.exp(forward[:, risk - 1].unsqueeze(1)), cumulative_hazard))
-
-        if isinstance(horizon, list):
-            # Interpolate to make the prediction at the point of interest
-            result = []
-            for h in horizon:
-                _, closest = torch.min((self.times <= h), 0)
-                closest -= 1
-                if closest < 0:
-                    result.append(torch.ones((len(predictions))))
-                else:
-                    result.append(predictions[:, closest])
-            predictions = torch.stack(result).T
         return predictions,
         
 
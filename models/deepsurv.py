@@ -1,7 +1,6 @@
 from .Survival.survival import Survival
 from .rnn_joint import RNNJoint
-from .utils import sort_given_t, pandas_to_list
-from copy import deepcopy
+from .utils import pandas_to_list, ModelBank, save_checkpoint, load_checkpoint, remove_checkpoint, WeightSnapshot
 import pandas as pd
 from tqdm import tqdm
 import torch.nn as nn
@@ -13,21 +12,27 @@ class DeepSurv():
         Encapsulator for torch to match sklearn methods
     """
     
-    def __init__(self, inputdim, outputdim = 1, cuda = torch.cuda.is_available(), **params):
+    def __init__(self, inputdim, outputdim = 1, cuda = torch.cuda.is_available(), dtype = torch.float64, **params):
+        """
+        Args:
+            dtype (torch.dtype): Precision of the network and data (float32 for speed)
+                Survival likelihood and baseline are always computed in float64
+        """
         self.model = Survival.create('deepsurv', inputdim, outputdim, **params)
     
         if cuda:
             self.model = self.model.cuda()
-        self.model = self.model.double()
+        self.model = self.model.to(dtype)
         self.fitted = False
         self.cuda = cuda
+        self.dtype = dtype
+        self.args = dict(params, inputdim = inputdim, outputdim = outputdim, dtype = str(dtype).replace('torch.', ''))
 
     def loss(self, x, i, m, e, t, batch = None):
         if not self.fitted:
             raise Exception("The model has not been fitted yet.")
         x, e, t = self.preprocess(x, e, t)
-        x, e, t = sort_given_t(x, e, t = t)
-        return self.model.loss(x, e, batch = batch).item() # Only survival loss
+        return self.model.loss(x, e, t, batch = batch).item() # Only survival loss
 
     def predict(self, x, i, m, horizon = None, risk = 1, batch = None):
         """
@@ -48,10 +53,11 @@ class DeepSurv():
         if not self.fitted:
             raise Exception("The model has not been fitted yet.")
         x, _, _= self.preprocess(x)
-        return self.model.predict(x, horizon = horizon, risk  = risk, batch = batch).detach().cpu().numpy()
+        with torch.no_grad():
+            return self.model.predict(x, horizon = horizon, risk  = risk, batch = batch).cpu().numpy()
 
     def fit(self, x_train, e_train, t_train,
-             x_valid = None, e_valid = None, t_valid = None, **params):
+             x_valid = None, e_valid = None, t_valid = None, repeats = None, **params):
         """
         Fit the model
 
@@ -61,6 +67,8 @@ class DeepSurv():
             m (List of Array or DataFrame n * [t_n * d]): List of mask 
             t (List of Array or DataFrame n * [t_n], optional): List of time to event # Used for survival only
             e (List or DataFrame n, optional): List of event (binary). Defaults to None.
+            (x can also be the tuple output of to_tensors - other arguments are then ignored)
+            repeats (Array n, optional): Number of times each training patient is used (oversampling). Defaults to None.
 
         Returns:
             self
@@ -70,96 +78,190 @@ class DeepSurv():
 
         self.model = train_torch_model(self.model,
             x_train, e_train, t_train,
-            x_valid, e_valid, t_valid, **params).eval()
+            x_valid, e_valid, t_valid, repeats = repeats, **params)
 
         if self.model:
-            self.model.compute_baseline(x_train, e_train, t_train, batch = 100)
+            self.model = self.model.eval()
+            self.model.compute_baseline(x_train, e_train, t_train, batch = 100,
+                weights = None if repeats is None else torch.as_tensor(repeats))
             self.fitted = True
             return self
         else:
             return None
 
+    @staticmethod
+    def fit_bank(models, x_train, e_train, t_train,
+             x_valid = None, e_valid = None, t_valid = None, repeats = None, **params):
+        """
+        Fit models of identical architecture in lockstep (see train_torch_bank)
+
+        Args:
+            models (List of DeepSurv): Models to fit (same architecture, precision and device)
+            Other arguments as for fit (lr and pruning can be given for each model)
+
+        Returns:
+            List of fitted models (None if training failed or was pruned)
+        """
+        x_train, e_train, t_train = models[0].preprocess(x_train, e_train, t_train)
+        x_valid, e_valid, t_valid = models[0].preprocess(x_valid, e_valid, t_valid)
+
+        trained = train_torch_bank([model.model for model in models],
+            x_train, e_train, t_train,
+            x_valid, e_valid, t_valid, repeats = repeats, **params)
+
+        fitted = []
+        for model, model_torch in zip(models, trained):
+            if model_torch:
+                model.model = model_torch.eval()
+                model.model.compute_baseline(x_train, e_train, t_train, batch = 100,
+                    weights = None if repeats is None else torch.as_tensor(repeats))
+                model.fitted = True
+                fitted.append(model)
+            else:
+                fitted.append(None)
+        return fitted
+
+    def state_dict(self):
+        """
+            Constructor arguments, parameters and baseline of the fitted model (tensors on cpu)
+        """
+        if not self.fitted:
+            raise Exception("The model has not been fitted yet.")
+        return {'args': self.args,
+                'model': {name: value.cpu() for name, value in self.model.state_dict().items()},
+                'baselines': self.model.baselines.cpu(), 'times': self.model.times.cpu()}
+
+    @classmethod
+    def from_state_dict(cls, state, cuda = torch.cuda.is_available()):
+        """
+            Fitted model from state_dict
+        """
+        args = dict(state['args'])
+        model = cls(cuda = cuda, dtype = getattr(torch, args.pop('dtype')), **args)
+        model.model.load_state_dict(state['model'])
+        model.model.baselines, model.model.times = state['baselines'], state['times']
+        model.model = model.model.eval()
+        model.fitted = True
+        return model
+
     def preprocess(self, x, e = None, t = None):
         """
         Preprocess data
             All lists need to have the same size
+            Data already preprocessed (tuple output of to_tensors) are used as is
             
         Returns:
-            6 Tensors: Padded Data, Padded Mask, Padded Interevent Time, Time to event, Target, Length
+            3 Tensors: Data, Target, Time to event
         """
         if x is None: 
             return None, None, None
 
+        if not isinstance(x, tuple):
+            x = DeepSurv.to_tensors(x, e, t)
+
+        # Network precision for inputs (event and time kept in float64)
+        x = (x[0].to(self.dtype),) + tuple(x[1:])
+
+        if self.cuda:
+            x = tuple(None if xi is None else xi.cuda() for xi in x)
+            
+        return x
+
+    @staticmethod
+    def to_tensors(x, e = None, t = None):
+        """
+        Convert data into tensors (on cpu)
+            Output can be given directly to fit, predict and loss in place of x
+
+        Returns:
+            Tuple of 3 Tensors: Data, Target, Time to event
+        """
         x = x.values if (isinstance(x, pd.DataFrame) or isinstance(x, pd.Series)) else x
         x = torch.DoubleTensor(x)
 
         if e is not None: 
             e = e.values if (isinstance(e, pd.DataFrame) or isinstance(e, pd.Series)) else e
             e = torch.DoubleTensor(e.copy()).unsqueeze(-1)
-            if self.cuda:
-                e = e.cuda()
 
         if t is not None:
             t = t.values if (isinstance(t, pd.DataFrame) or isinstance(t, pd.Series)) else t
             t = torch.DoubleTensor(t).unsqueeze(-1)
-
-            if self.cuda:
-                t = t.cuda()
-
-        if self.cuda:
-            x = x.cuda()
             
         return x, e, t
 
 def train_torch_model(model_torch, 
     x_train, e_train, t_train,
     x_valid, e_valid, t_valid,
-    epochs = 500, pretrain_ite = 500, lr = 0.0001, batch = 500, patience = 5, weight_decay = 0.001):
+    epochs = 500, pretrain_ite = 500, lr = 0.0001, batch = 500, patience = 5, weight_decay = 0.001, repeats = None, pruning = None, checkpoint = None, snapshot_every = 1):
+    """
+        Train the model with early stopping on validation loss
+        repeats (Array n): Number of times each patient is used in each epoch (oversampling without copy)
+        pruning (callable): Called with the number of epochs and best validation loss, stops training if True (returns None)
+        checkpoint (str): Path to save the training state at each epoch (training resumes from it if it exists)
+        snapshot_every (int): Best weights are only copied at epochs multiple of snapshot_every (1: at each improvement)
+    """
 
     # Initialization parameters
-    t_bar = tqdm(range(epochs + pretrain_ite))
+    wait = 0
+    state = load_checkpoint(checkpoint)
+    t_bar = tqdm(range(0 if state is None else state['epoch'], epochs + pretrain_ite))
     
-    nbatches = int(x_train.shape[0] / batch) + 1 # Number batch
-    batch_order = np.arange(x_train.shape[0]) # Index of all data in training
     previous_loss, best_loss = np.inf, np.inf # Keep track of losses
-    best_weight = deepcopy(model_torch.state_dict()) # Keep best parameters
+    best_weight = WeightSnapshot(model_torch) # Keep best parameters (copied in place)
     
     optimizer = torch.optim.Adam(model_torch.parameters(), lr = lr, weight_decay = weight_decay)
 
-    # Sort batch for likelihood computation
-    x_train, e_train, t_train = sort_given_t(x_train, e_train, t = t_train)
-    if x_valid is not None:
-        x_valid, e_valid, t_valid = sort_given_t(x_valid, e_valid, t = t_valid)
+    # Risk sets are computed in the loss: no order needed
+    repeats = torch.ones(x_train.shape[0], dtype = torch.long) if repeats is None else torch.as_tensor(repeats)
+    batch_order = np.repeat(np.arange(x_train.shape[0]), repeats.cpu().numpy()) # Index of all data in training (with oversampling)
+    nbatches = int(len(batch_order) / batch) + 1 # Number batch
+
+    if state is not None:
+        # Resume interrupted training
+        previous_loss, best_loss, wait = state['previous_loss'], state['best_loss'], state['wait']
+        best_weight.load(state['best_weight'])
+        batch_order = state['batch_order']
+        model_torch.load_state_dict(state['model'])
+        optimizer.load_state_dict(state['optimizer'])
+        np.random.set_state(state['numpy_state'])
+        torch.set_rng_state(state['torch_state'])
 
     for i in t_bar:
+        if checkpoint is not None:
+            # State at the beginning of the epoch
+            save_checkpoint(checkpoint, epoch = i, model = model_torch.state_dict(), optimizer = optimizer.state_dict(),
+                previous_loss = previous_loss, best_loss = best_loss, best_weight = best_weight.state(), wait = wait,
+                batch_order = batch_order, numpy_state = np.random.get_state(), torch_state = torch.get_rng_state())
+
         model_torch.train()
         # Random batch for backprop training
         np.random.shuffle(batch_order)
         for j in range(nbatches):
-            order = np.sort(batch_order[j*batch:(j+1)*batch]) # Need to conserve order
-            xb, eb = x_train[order], e_train[order]
+            order = batch_order[j*batch:(j+1)*batch]
+            xb, eb, tb = x_train[order], e_train[order], t_train[order]
 
             if xb.shape[0] == 0:
                 continue
 
             optimizer.zero_grad()
-            loss = model_torch.loss(xb, eb)
+            loss = model_torch.loss(xb, eb, tb)
             loss.backward()
             optimizer.step()
         
         # Evaluate validation loss - Batch
         if x_valid is None:
-            best_weight = deepcopy(model_torch.state_dict())
+            # Last weights are kept
             continue
         
         model_torch.eval()
-        loss = model_torch.loss(x_valid, e_valid, batch = batch).item()
+        loss = model_torch.loss(x_valid, e_valid, t_valid, batch = batch).item()
         
         t_bar.set_description("Loss survival: {:.3f}".format(loss))
-        t_bar.set_postfix({'Minimal loss observed': best_loss})
+        t_bar.set_postfix({'Minimal loss observed': best_loss, 'Snapshot time': best_weight.time})
 
         if np.isnan(loss):
             print('ERROR - Loss')
+            remove_checkpoint(checkpoint)
             return None
 
         if loss > previous_loss:
@@ -168,15 +270,121 @@ def train_torch_model(model_torch,
                 break
             else:
                 wait += 1
-        elif loss < best_loss:
+        elif loss < best_loss and (i + 1) % snapshot_every == 0:
             # Update new best
-            best_weight = deepcopy(model_torch.state_dict())
+            best_weight.take()
             best_loss = loss
             wait = 0
         else:
             wait = 0
+
+        if pruning is not None and pruning(i + 1, best_loss):
+            # Clearly worse than other configurations
+            remove_checkpoint(checkpoint)
+            return None
         
         previous_loss = loss
     
-    model_torch.load_state_dict(best_weight)            
-    return model_torch
\ No newline at end of file
+    remove_checkpoint(checkpoint)
+    if x_valid is not None:
+        best_weight.restore()
+    return model_torch
+
+
+def train_torch_bank(models_torch, 
+    x_train, e_train, t_train,
+    x_valid, e_valid, t_valid,
+    epochs = 500, pretrain_ite = 500, lr = 0.0001, batch = 500, patience = 5, weight_decay = 0.001, repeats = None, pruning = None):
+    """
+        Train models of identical architecture in lockstep on the same batches (see train_torch_model)
+        Each member has its own learning rate, optimizer state, early stopping and pruning
+        lr (float or List): Learning rate of each member
+        pruning (List of callable): Pruning of each member (see train_torch_model)
+
+        Returns:
+            List of trained models (None if training failed or was pruned)
+    """
+    members = len(models_torch)
+    lr = lr if isinstance(lr, list) else [lr] * members
+    bank = ModelBank(models_torch)
+
+    # Initialization parameters
+    t_bar = tqdm(range(epochs + pretrain_ite))
+
+    previous_loss, best_loss = np.full(members, np.inf), np.full(members, np.inf) # Keep track of losses
+    wait = np.zeros(members, dtype = int)
+    best_weight = [WeightSnapshot(model_torch) for model_torch in models_torch] # Keep best parameters (copied in place)
+    trained, active = list(models_torch), list(range(members))
+
+    # One parameter group by member (stopped members have no gradient and are not updated)
+    optimizer = torch.optim.Adam([{'params': model_torch.parameters(), 'lr': lr_k} for model_torch, lr_k in zip(models_torch, lr)], 
+        weight_decay = weight_decay)
+
+    # Risk sets are computed in the loss: no order needed
+    repeats = torch.ones(x_train.shape[0], dtype = torch.long) if repeats is None else torch.as_tensor(repeats)
+    batch_order = np.repeat(np.arange(x_train.shape[0]), repeats.cpu().numpy()) # Index of all data in training (with oversampling)
+    nbatches = int(len(batch_order) / batch) + 1 # Number batch
+
+    for i in t_bar:
+        # Random batch for backprop training
+        np.random.shuffle(batch_order)
+        for j in range(nbatches):
+            order = batch_order[j*batch:(j+1)*batch]
+            xb, eb, tb = x_train[order], e_train[order], t_train[order]
+
+            if xb.shape[0] == 0:
+                continue
+
+            optimizer.zero_grad()
+            loss = bank('loss', active, xb, eb, tb)
+            loss.sum().backward()
+            optimizer.step()
+        
+        # Evaluate validation loss - Batch
+        if x_valid is None:
+            # Last weights are kept
+            continue
+        
+        with torch.no_grad():
+            losses = bank('loss', active, x_valid, e_valid, t_valid, batch = batch).cpu().numpy()
+        
+        t_bar.set_description("Members training: {} - Loss survival: {:.3f}".format(len(active), losses.min()))
+        t_bar.set_postfix({'Minimal loss observed': best_loss.min()})
+
+        for k, loss in zip(list(active), losses):
+            if np.isnan(loss):
+                print('ERROR - Loss')
+                trained[k] = None
+                active.remove(k)
+                continue
+
+            if loss > previous_loss[k]:
+                # If less good than before
+                if wait[k] == patience:
+                    active.remove(k)
+                    continue
+                else:
+                    wait[k] += 1
+            elif loss < best_loss[k]:
+                # Update new best
+                best_weight[k].take()
+                best_loss[k] = loss
+                wait[k] = 0
+            else:
+                wait[k] = 0
+
+            if pruning is not None and pruning[k](i + 1, float(best_loss[k])):
+                # Clearly worse than other configurations
+                trained[k] = None
+                active.remove(k)
+                continue
+            
+            previous_loss[k] = loss
+
+        if len(active) == 0:
+            break
+    
+    if x_valid is not None:
+        for weight in best_weight:
+            weight.restore()
+    return trained
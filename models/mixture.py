@@ -16,6 +16,7 @@ class Mixture(BatchForward):
         """
         Args:
             k (int): Number of components for mixture of observational processes
+                (Components of each process evaluated at once - stacked parameters)
             inputdim (int): Input dimension (Embedded input)
             outputdim (int, optional): Output dimension (Input dimension)
             
@@ -45,32 +46,47 @@ class Mixture(BatchForward):
         else:
             self.alphas = torch.ones_like
 
-        self.temporal = nn.ModuleList([Temporal.create(temporal, inputdim, 1, temporal_args) for _ in range(k)])
-        self.longitudinal = nn.ModuleList([Longitudinal.create(longitudinal, inputdim, outputdim, longitudinal_args) for _ in range(k)])
-        self.missing = nn.ModuleList([Missing.create(missing, inputdim, outputdim, missing_args) for _ in range(k)])
+        self.temporal = Temporal.create(temporal, inputdim, 1, temporal_args, k)
+        self.longitudinal = Longitudinal.create(longitudinal, inputdim, outputdim, longitudinal_args, k)
+        self.missing = Missing.create(missing, inputdim, outputdim, missing_args, k)
+        self._register_load_state_dict_pre_hook(self._stack_components)
+
+    def _stack_components(self, state_dict, prefix, *args):
+        # Previous state (one module by component: head.j.parameter) stacked along a first dimension
+        for head in ['temporal', 'longitudinal', 'missing']:
+            start = '{}{}.0.'.format(prefix, head)
+            for key in [key for key in state_dict if key.startswith(start)]:
+                name = key[len(start):]
+                components = [state_dict.pop('{}{}.{}.{}'.format(prefix, head, j, name)) for j in range(self.k)]
+                state_dict['{}{}.{}'.format(prefix, head, name)] = torch.stack(components)
 
     def forward_batch(self, h, i, m, l):
         """
             Forward through the different networks
         """
-        temp_res = long_res = miss_res = torch.zeros(1, device = h.get_device() if h.is_cuda else 'cpu')
-        alphas = self.alphas(h[:, :-1])
-        for j, (temp, long, miss) in enumerate(zip(self.temporal, self.longitudinal, self.missing)):
-            alphas_repeat = alphas[:, :, j].unsqueeze(2).repeat(1, 1, self.outputdim)
-            temp_res += (alphas[:, :, j] * temp.forward_batch(h, i, m, l)[0]) if temp is not None else 0
-            long_res += (alphas_repeat * long.forward_batch(h, i, m, l)[0]) if long is not None else 0
-            miss_res += (alphas_repeat * miss.forward_batch(h, i, m, l)[0]) if miss is not None else 0
+        alphas = self.alphas(h[:, :-1])[:, :, :self.k]
+        weights = alphas.permute(2, 0, 1) # Components first (broadcasted on outputs)
+
+        # Heads not modelled: zeros of the output shape (concatenated across batches)
+        temp_res = (weights * self.temporal.forward_batch(h, i, m, l)[0]).sum(0) if self.temporal is not None \
+            else alphas.new_zeros(alphas.shape[:2])
+        long_res = (weights.unsqueeze(-1) * self.longitudinal.forward_batch(h, i, m, l)[0]).sum(0) if self.longitudinal is not None \
+            else alphas.new_zeros(alphas.shape[:2] + (self.outputdim,))
+        miss_res = (weights.unsqueeze(-1) * self.missing.forward_batch(h, i, m, l)[0]).sum(0) if self.missing is not None \
+            else alphas.new_zeros(alphas.shape[:2] + (self.outputdim,))
 
         return temp_res, long_res, miss_res, alphas
 
     def loss(self, h, x, i, m, l, batch = None, reduction = 'mean'):
-        loss_temp = loss_long = loss_miss = torch.zeros(1, device = x.get_device() if x.is_cuda else 'cpu')
-        alphas = self.alphas(h[:, :-1])
-        for j, (temp, long, miss) in enumerate(zip(self.temporal, self.longitudinal, self.missing)):
-            # Elbo loss (alpha could be computed exactly)
-            alphas_repeat = alphas[:, :, j].unsqueeze(2).repeat(1, 1, x.size(2))
-            loss_temp += temp.loss(alphas[:, :, j], h, i, m, l, batch, reduction) if temp is not None else 0
-            loss_long += long.loss(alphas_repeat, h, x, i, m, l, batch, reduction) if long is not None else 0
-            loss_miss += miss.loss(alphas_repeat, h, i, m, l, batch, reduction) if miss is not None else 0
+        zero = torch.zeros((), dtype = h.dtype, device = h.device)
+        alphas = self.alphas(h[:, :-1])[:, :, :self.k]
+
+        # Elbo loss (alpha could be computed exactly)
+        # All components at once: the losses sum over the first (component) dimension
+        weights = alphas.permute(2, 0, 1)
+        weights_repeat = weights.unsqueeze(-1).expand(-1, -1, -1, x.size(2)) # View: no copy
+        loss_temp = self.temporal.loss(weights, h, i, m, l, batch, reduction) if self.temporal is not None else zero
+        loss_long = self.longitudinal.loss(weights_repeat, h, x, i, m, l, batch, reduction) if self.longitudinal is not None else zero
+        loss_miss = self.missing.loss(weights_repeat, h, i, m, l, batch, reduction) if self.missing is not None else zero
 
-        return loss_temp, loss_long, loss_miss
\ No newline at end of file
+        return loss_temp, loss_long, loss_miss
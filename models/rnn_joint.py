@@ -1,6 +1,5 @@
 from .rnn_joint_torch import RNNJointTorch
-from .utils import sort_given_t, pandas_to_list, compute_dwa
-from copy import deepcopy
+from .utils import pandas_to_offsets, offsets_to_padded, length_batches, compute_dwa, save_checkpoint, load_checkpoint, remove_checkpoint, WeightSnapshot, BatchLoader, packed, map_buffers
 import pandas as pd
 from tqdm import tqdm
 import torch.nn as nn
@@ -12,17 +11,27 @@ class RNNJoint():
         Encapsulator for torch to match sklearn methods
     """
     
-    def __init__(self, inputdim, outputdim = 1, cuda = torch.cuda.is_available(), **params):
+    def __init__(self, inputdim, outputdim = 1, cuda = torch.cuda.is_available(), dtype = torch.float64, **params):
+        """
+        Args:
+            dtype (torch.dtype): Precision of the network and data (float32 for speed)
+                Survival likelihood and baseline are always computed in float64
+        """
         self.model = RNNJointTorch(inputdim, outputdim, **params)
     
         if cuda:
             self.model = self.model.cuda()
-        self.model = self.model.double()
+        self.model = self.model.to(dtype)
         self.fitted = False
         self.cuda = cuda
+        self.dtype = dtype
+        self.args = dict(params, inputdim = inputdim, outputdim = outputdim, dtype = str(dtype).replace('torch.', ''))
+        if self.args.get('mixture_mask') is not None:
+            # Plain types only (loaded with weights_only)
+            self.args['mixture_mask'] = np.asarray(self.args['mixture_mask']).tolist()
         
     def fit(self, x_train, i_train, m_train, e_train, t_train, 
-             x_valid = None, i_valid = None, m_valid = None, e_valid = None, t_valid = None, **params):
+             x_valid = None, i_valid = None, m_valid = None, e_valid = None, t_valid = None, repeats = None, **params):
         """
         Fit the model
 
@@ -32,6 +41,8 @@ class RNNJoint():
             m (List of Array or DataFrame n * [t_n * d]): List of mask 
             t (List of Array or DataFrame n * [t_n], optional): List of time to event # Used for survival only
             e (List or DataFrame n, optional): List of event (binary). Defaults to None.
+            (x can also be the tuple output of to_tensors - other arguments are then ignored)
+            repeats (Array n, optional): Number of times each training patient is used (oversampling). Defaults to None.
 
         Returns:
             self
@@ -41,11 +52,12 @@ class RNNJoint():
 
         self.model = train_torch_model(self.model,
             x_train, i_train, m_train, e_train, l_train, t_train, 
-            x_valid, i_valid, m_valid, e_valid, l_valid, t_valid, **params)
+            x_valid, i_valid, m_valid, e_valid, l_valid, t_valid, repeats = repeats, **params)
 
         if self.model:
             self.model = self.model.eval()
-            self.model.compute_baseline(x_train, i_train, m_train, e_train, l_train, t_train, batch = 100)
+            self.model.compute_baseline(x_train, i_train, m_train, e_train, l_train, t_train, batch = 100,
+                weights = None if repeats is None else torch.as_tensor(repeats))
             self.fitted = True
             return self
         else:
@@ -70,7 +82,8 @@ class RNNJoint():
         if not self.fitted:
             raise Exception("The model has not been fitted yet.")
         x, i, m, _, l, _ = self.preprocess(x, i, m)
-        return self.model.predict(x, i, m, l, horizon = horizon, risk = risk, batch = batch).detach().cpu().numpy()
+        with torch.no_grad():
+            return self.model.predict(x, i, m, l, horizon = horizon, risk = risk, batch = batch).cpu().numpy()
 
     def observational_predict(self, x, i, m, batch = None):
         if not self.fitted:
@@ -82,7 +95,6 @@ class RNNJoint():
         if not self.fitted:
             raise Exception("The model has not been fitted yet.")
         x, i, m, e, l, t = self.preprocess(x, i, m, e, t)
-        x, i, m, e, l, t = sort_given_t(x, i, m, e, l, t = t)
         return self.model.loss(x, i, m, e, l, t, batch, observational = False)[0].item() # Only survival loss
 
     def loss_observational(self, x, i, m, batch = None):
@@ -95,7 +107,6 @@ class RNNJoint():
         if not self.fitted:
             raise Exception("The model has not been fitted yet.")
         x_p, i_p, m_p, e_p, l_p, t_p = self.preprocess(x, i, m, e, t)
-        x_p, i_p, m_p, e_p, l_p, t_p = sort_given_t(x_p, i_p, m_p, e_p, l_p, t = t_p)
         global_nll = self.model.loss(x_p, i_p, m_p, e_p, l_p, t_p, batch)[1]
         if 'observational' in global_nll:
             global_nll =  {'Survival': global_nll['survival'].item(), 
@@ -115,8 +126,7 @@ class RNNJoint():
                 x_p = pd.DataFrame(x_p, index = x.index)
                 
                 x_p, i_p, m_p, e_p, l_p, t_p = self.preprocess(x, i, m, e, t)
-                x_p, i_p, m_p, e_p, l_p, t_p = sort_given_t(x_p, i_p, m_p, e_p, l_p, t = t_p)
-
+        
                 nll = self.model.loss(x_p, i_p, m_p, e_p, l_p, t_p, batch)[1]
                 performances['Survival'][j].append(nll['survival'].item())
 
@@ -128,10 +138,36 @@ class RNNJoint():
         return {c: {j: (np.array(performances[c][j]) - global_nll[c]) / global_nll[c] for j in performances[c]} for c in performances}
           
 
+    def state_dict(self):
+        """
+            Constructor arguments, parameters and baseline of the fitted model (tensors on cpu)
+        """
+        if not self.fitted:
+            raise Exception("The model has not been fitted yet.")
+        return {'args': self.args,
+                'model': {name: value.cpu() for name, value in self.model.state_dict().items()},
+                'baselines': self.model.survival_model.baselines.cpu(), 'times': self.model.survival_model.times.cpu()}
+
+    @classmethod
+    def from_state_dict(cls, state, cuda = torch.cuda.is_available()):
+        """
+            Fitted model from state_dict
+        """
+        args = dict(state['args'])
+        if args.get('mixture_mask') is not None:
+            args['mixture_mask'] = np.array(args['mixture_mask'])
+        model = cls(cuda = cuda, dtype = getattr(torch, args.pop('dtype')), **args)
+        model.model.load_state_dict(state['model'])
+        model.model.survival_model.baselines, model.model.survival_model.times = state['baselines'], state['times']
+        model.model = model.model.eval()
+        model.fitted = True
+        return model
+
     def preprocess(self, x, i, m, e = None, t = None):
         """
         Preprocess data
             All lists need to have the same size
+            Data already preprocessed (tuple output of to_tensors) are used as is
             
         Returns:
             6 Tensors: Padded Data, Padded Mask, Padded Interevent Time, Time to event, Target, Length
@@ -139,66 +175,116 @@ class RNNJoint():
         if x is None: 
             return None, None, None, None, None, None
 
-        x = pandas_to_list(x)
-        i = pandas_to_list(i)
-        m = pandas_to_list(m)
-
-        # X and T Padding
-        xres, ires, mres, l = [], [], [], [len(xi) for xi in x]
-        max_length = max(l)
-        for xi, ii, mi, li in zip(x, i, m, l):
-            # Compute time differences between successive points
-            xres.append(np.concatenate([xi, np.zeros(shape = (max_length - li, xi.shape[1]))]))
-            ires.append(np.concatenate([ii, np.zeros(shape = (max_length - li))]))
-            mres.append(np.concatenate([mi, np.zeros(shape = (max_length - li, mi.shape[1]))]))
-        x = torch.from_numpy(np.array(xres, dtype=float)).double()
-        i = torch.from_numpy(np.array(ires, dtype=float)).double()
-        m = torch.from_numpy(np.array(mres, dtype=float)) > 0.5
-        l = torch.LongTensor(l)
+        if not isinstance(x, tuple):
+            x = RNNJoint.to_tensors(x, i, m, e, t)
+
+        # Network precision for inputs (event and time kept in float64)
+        x, i, m, e, l, t = x
+        x, i = map_buffers([x, i], lambda buffer: buffer.to(self.dtype))
+        x = (x, i, m, e, l, t)
+
+        if self.cuda:
+            # Buffers moved once (tensors stay views on them)
+            x = tuple(map_buffers(x, lambda buffer: buffer.cuda()))
+
+        return x
+
+    @staticmethod
+    def to_tensors(x, i, m, e = None, t = None):
+        """
+        Convert data into padded tensors (on cpu)
+            Output can be given directly to fit, predict and loss in place of x
+
+        Returns:
+            Tuple of 6 Tensors: Padded Data, Padded Mask, Padded Interevent Time, Time to event, Target, Length
+        """
+        # Split all patients at once (same offsets for x, i and m)
+        x, offsets = pandas_to_offsets(x)
+        i, _ = pandas_to_offsets(i)
+        m, _ = pandas_to_offsets(m)
 
         if e is not None: 
             e = e.values if (isinstance(e, pd.DataFrame) or isinstance(e, pd.Series)) else e
-            e = torch.DoubleTensor(e.copy()).unsqueeze(-1)
-            if self.cuda:
-                e = e.cuda()
+            e = np.asarray(e, dtype = float)[..., None]
 
         if t is not None:
-            t = pandas_to_list(t)
-            t = torch.from_numpy(np.array([ti[li - 1] for ti, li in zip(t, l)])).double().unsqueeze(-1)
-
-            if self.cuda:
-                t = t.cuda()
-
-        if self.cuda:
-            x, i, m, l = x.cuda(), i.cuda(), m.cuda(), l.cuda()
+            t, t_offsets = pandas_to_offsets(t)
+            t = np.array(t[t_offsets[1:] - 1], dtype = float)[..., None] # Last time of each patient
+
+        # Float tensors (X, T, event and time) in one buffer: batches gathered at once
+        lengths = np.diff(offsets)
+        shapes = [(lengths.max(),) + values.shape[1:] for values in (x, i)] + [values.shape[1:] for values in (e, t) if values is not None]
+        buffers = iter(packed(len(lengths), shapes))
+
+        # X, T and M Padding - Single allocation for each
+        x_values, x = x, next(buffers)
+        offsets_to_padded(x_values, offsets, out = x.numpy())
+        i_values, i = i, next(buffers)
+        offsets_to_padded(i_values, offsets, out = i.numpy())
+        m = torch.from_numpy(offsets_to_padded(np.asarray(m, dtype = float) > 0.5, offsets, dtype = bool))
+        l = torch.from_numpy(lengths)
+        e, t = [None if values is None else next(buffers).copy_(torch.from_numpy(values)) for values in (e, t)]
             
         return x, i, m, e, l, t
 
 def train_torch_model(model_torch, 
     x_train, i_train, m_train, e_train, l_train, t_train,
     x_valid, i_valid, m_valid, e_valid, l_valid, t_valid,
-    epochs = 500, pretrain_ite = 500, lr = 0.0001, batch = 500, patience = 2, weight_decay = 0.001, full_finetune = False):
+    epochs = 500, pretrain_ite = 500, lr = 0.0001, batch = 500, patience = 2, weight_decay = 0.001, full_finetune = False, bucket = 0, repeats = None, pruning = None, checkpoint = None, snapshot_every = 1, prefetch = 2):
+    """
+        Train the model with early stopping on validation survival loss
+        bucket (int): Batch patients of similar lengths within pools of bucket batches
+            and trim each batch to its own maximum length (0: random batches)
+        repeats (Array n): Number of times each patient is used in each epoch (oversampling without copy)
+        pruning (callable): Called with the number of epochs and best validation loss, stops training if True (returns None)
+        checkpoint (str): Path to save the training state at each epoch (training resumes from it if it exists)
+        snapshot_every (int): Best weights are only copied at epochs multiple of snapshot_every (1: at each improvement)
+        prefetch (int): Number of batches gathered in advance by a background thread (0: no thread)
+    """
 
     # Initialization parameters
     weights = {}
     full = True
-    t_bar = tqdm(range(epochs + pretrain_ite))
+    wait, survival_loss = 0, np.inf
+    state = load_checkpoint(checkpoint)
+    t_bar = tqdm(range(0 if state is None else state['epoch'], epochs + pretrain_ite))
     
-    nbatches = int(x_train.shape[0] / batch) + 1 # Number batch
-    batch_order = np.arange(x_train.shape[0]) # Index of all data in training
     previous_loss, best_loss = np.inf, np.inf # Keep track of losses
-    best_weight = deepcopy(model_torch.state_dict()) # Keep best parameters
+    best_weight = WeightSnapshot(model_torch) # Keep best parameters (copied in place)
 
     previous_losses, previous_losses_2 = {}, {} # Observational weighting (different losses are weighted differently)
     
     optimizer = torch.optim.Adam(model_torch.parameters(), lr = lr, weight_decay = weight_decay)
 
-    # Sort batch for likelihood computation
-    x_train, i_train, m_train, e_train, l_train, t_train = sort_given_t(x_train, i_train, m_train, e_train, l_train, t = t_train)
-    if x_valid is not None:
-        x_valid, i_valid, m_valid, e_valid, l_valid, t_valid = sort_given_t(x_valid, i_valid, m_valid, e_valid, l_valid, t = t_valid)
+    # Risk sets are computed in the loss: no order needed
+    repeats = torch.ones(x_train.shape[0], dtype = torch.long) if repeats is None else torch.as_tensor(repeats)
+    batch_order = np.repeat(np.arange(x_train.shape[0]), repeats.cpu().numpy()) # Index of all data in training
+    nbatches = int(len(batch_order) / batch) + 1 # Number batch
+    loader = BatchLoader([x_train, i_train, m_train, t_train, e_train, l_train], prefetch) # Batches gathered in background
+
+    if state is not None:
+        # Resume interrupted training
+        full, pretrain_ite, wait, survival_loss = state['full'], state['pretrain_ite'], state['wait'], state['survival_loss']
+        previous_loss, best_loss = state['previous_loss'], state['best_loss']
+        best_weight.load(state['best_weight'])
+        weights, previous_losses, previous_losses_2 = state['weights'], state['previous_losses'], state['previous_losses_2']
+        batch_order = state['batch_order']
+        model_torch.load_state_dict(state['model'])
+        if not full and not full_finetune:
+            optimizer = torch.optim.Adam(model_torch.survival_model.parameters(), lr = lr, weight_decay = weight_decay)
+        optimizer.load_state_dict(state['optimizer'])
+        np.random.set_state(state['numpy_state'])
+        torch.set_rng_state(state['torch_state'])
 
     for i in t_bar:
+        if checkpoint is not None:
+            # State at the beginning of the epoch
+            save_checkpoint(checkpoint, epoch = i, model = model_torch.state_dict(), optimizer = optimizer.state_dict(),
+                full = full, pretrain_ite = pretrain_ite, wait = wait, survival_loss = survival_loss,
+                previous_loss = previous_loss, best_loss = best_loss, best_weight = best_weight.state(),
+                weights = weights, previous_losses = previous_losses, previous_losses_2 = previous_losses_2,
+                batch_order = batch_order, numpy_state = np.random.get_state(), torch_state = torch.get_rng_state())
+
         if i == pretrain_ite:
             # End pretraining => Train only the survival model
             ## Upload best weights and reinitalize losses
@@ -215,14 +301,16 @@ def train_torch_model(model_torch,
 
         model_torch.train()
         # Random batch for backprop training
-        np.random.shuffle(batch_order)
-        for j in range(nbatches):
-            order = np.sort(batch_order[j*batch:(j+1)*batch]) # Need to conserve order
-            xb, ib, mb, tb, eb, lb = x_train[order], i_train[order], m_train[order],\
-                                     t_train[order], e_train[order], l_train[order]
-
-            if xb.shape[0] == 0:
-                continue
+        if bucket:
+            batches = [batch_order[b] for b in length_batches(l_train.cpu().numpy()[batch_order], batch, bucket)]
+        else:
+            np.random.shuffle(batch_order)
+            batches = [batch_order[j*batch:(j+1)*batch] for j in range(nbatches)]
+        for xb, ib, mb, tb, eb, lb in loader.iterate(batches):
+            if bucket:
+                # Remove padding common to the whole batch
+                trim = int(lb.max())
+                xb, ib, mb = xb[:, :trim], ib[:, :trim], mb[:, :trim]
 
             optimizer.zero_grad()
             loss, _ = model_torch.loss(xb, ib, mb, eb, lb, tb, 
@@ -232,7 +320,7 @@ def train_torch_model(model_torch,
         
         # Evaluate validation loss - Batch
         if x_valid is None:
-            best_weight = deepcopy(model_torch.state_dict())
+            # Last weights are kept
             continue
         
         model_torch.eval()
@@ -245,19 +333,25 @@ def train_torch_model(model_torch,
             t_bar.set_description("Loss full: {:.3f} - {:.3f}".format(loss.item(), previous_losses['survival'].item()))
         else:
             t_bar.set_description("Loss survival: {:.3f}".format(loss.item()))
-        t_bar.set_postfix({'Minimal loss observed': best_loss})
+        t_bar.set_postfix({'Minimal loss observed': best_loss, 'Snapshot time': best_weight.time})
         survival_loss = previous_losses['survival'].item()
         
         if np.isnan(survival_loss):
             print('ERROR - Loss')
+            remove_checkpoint(checkpoint)
             return None
 
-        if survival_loss < best_loss:
+        if survival_loss < best_loss and (i + 1) % snapshot_every == 0:
             # Update new best
-            best_weight = deepcopy(model_torch.state_dict())
+            best_weight.take()
             best_loss = survival_loss
             wait = 0
 
+        if pruning is not None and pruning(i + 1, best_loss):
+            # Clearly worse than other configurations
+            remove_checkpoint(checkpoint)
+            return None
+
         if loss > previous_loss:
             # If less good than before
             if full and (wait == patience):
@@ -271,5 +365,7 @@ def train_torch_model(model_torch,
         
         previous_loss = loss
 
-    model_torch.load_state_dict(best_weight)            
+    remove_checkpoint(checkpoint)
+    if x_valid is not None:
+        best_weight.restore()
     return model_torch
\ No newline at end of file
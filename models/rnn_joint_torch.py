@@ -73,19 +73,20 @@ class RNNJointTorch(BatchForward):
                                                 longitudinal, longitudinal_args, 
                                                 missing, missing_args)
 
-    def compute_baseline(self, x, i, m, e, l, t, batch = None):
+    @torch.no_grad()
+    def compute_baseline(self, x, i, m, e, l, t, batch = None, weights = None):
         hp, _ = self.embedding.forward(x, i, m, l, batch = batch)
-        self.survival_model.compute_baseline(hp, e, t, batch = batch)
+        self.survival_model.compute_baseline(hp, e, t, batch = batch, weights = weights)
         return self
     
     def loss(self, x, i, m, e, l, t, batch = None, reduction = 'mean', survival = True, observational = True, weights = {}):
         """
-            Compute loss model (need sorted if survival == True)
+            Compute loss model (any order of patients)
         """
         hp, hidden = self.embedding.forward(x, i, m, l, batch = batch)
         loss, losses = 0, {}
         if survival:
-            loss = losses['survival'] = self.survival_model.loss(hp, e, batch, reduction)
+            loss = losses['survival'] = self.survival_model.loss(hp, e, t, batch, reduction)
 
         if self.observational and observational:    
             losses['observational'] = torch.stack(self.observational_model.loss(hidden, x[:, :, self.mixture_mask], i, m[:, :, self.mixture_mask], l, batch, reduction))
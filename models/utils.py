@@ -1,25 +1,58 @@
+from torch.func import functional_call, vmap
+from time import perf_counter
+from threading import Thread, Event
+from queue import Queue
 import numpy as np
+import os
 import pandas as pd
 import torch.nn as nn
 import torch
 
-def pandas_to_list(x):
+def pandas_to_offsets(x):
     """
-        Split pandas dataframe with multi index into list of array
-        (Allow to split into multiple patients)
+        Split pandas dataframe with multi index into values and offsets
+        Patient k corresponds to values[offsets[k]:offsets[k + 1]]
+        (Group boundaries computed once - no copy if already grouped by patient)
     """
     if isinstance(x, pd.DataFrame) or isinstance(x, pd.Series):
-        result = []
-        for patient in x.index.unique(level = 0):
-            selection = x.index.get_level_values(0) == patient
-            result.append(x[selection].values)
-        return result
+        codes, _ = pd.factorize(x.index.get_level_values(0))
+        values = x.values
+        if (np.diff(codes) < 0).any():
+            # Patients not contiguous: stable reorder to keep time order
+            order = np.argsort(codes, kind = 'stable')
+            codes, values = codes[order], values[order]
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(codes))])
+        return values, offsets
     elif isinstance(x, list):
-        return x
+        offsets = np.concatenate([[0], np.cumsum([len(xi) for xi in x])]).astype(int)
+        return np.concatenate(x), offsets
     else:
         print(x)
         raise ValueError("Data not in the right format")
 
+def pandas_to_list(x):
+    """
+        Split pandas dataframe with multi index into list of array
+        (Allow to split into multiple patients)
+    """
+    if isinstance(x, list):
+        return x
+    values, offsets = pandas_to_offsets(x)
+    return [values[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+def offsets_to_padded(values, offsets, dtype = float, out = None):
+    """
+        Scatter values split by offsets into a zero padded array [n, max_length, ...]
+        (One allocation - Row r of patient k goes to [k, r - offsets[k]])
+        out: Zero array in which to scatter (no allocation)
+    """
+    lengths = np.diff(offsets)
+    padded = np.zeros((len(lengths), lengths.max()) + values.shape[1:], dtype = dtype) if out is None else out
+    patients = np.repeat(np.arange(len(lengths)), lengths)
+    positions = np.arange(offsets[-1]) - np.repeat(offsets[:-1], lengths)
+    padded[patients, positions] = values
+    return padded
+
 def create_nn(inputdim, layers, layer_unit = nn.Linear, activation = 'ReLU'):
     """
         Create a simple multi layer perceptron
@@ -43,31 +76,224 @@ def create_nn(inputdim, layers, layer_unit = nn.Linear, activation = 'ReLU'):
 
     return modules
 
-def get_last_observed(x, l):
+def stacked_linear(x, weight, bias = None):
     """
-        Extracts from xi the li observations
+        Linear layers of k components at once (one batched matmul)
+        x [k, ..., in], weight [k, out, in] and bias [k, out]: Returns [k, ..., out]
     """
-    if x.is_cuda:
-        device = x.get_device()
+    flat = x.reshape(len(weight), -1, x.shape[-1])
+    weight = weight.transpose(1, 2).contiguous() # Small copy: bmm is twice slower on transposed matrices (cpu)
+    if bias is None:
+        output = torch.bmm(flat, weight)
     else:
-        device = torch.device("cpu")
-
-    index = torch.arange(x.size(1)).repeat(x.size(0), 1).to(device)
-    last = index == l.unsqueeze(1).repeat(1, x.size(1))
+        output = torch.baddbmm(bias.unsqueeze(1), flat, weight)
+    return output.view(x.shape[:-1] + (weight.shape[2],))
 
-    return x[last]
+def add_last_input(hidden, tau, weight):
+    """
+        Adds the contribution of tau, last input of the stacked layer, to hidden [k, ..., out]
+        (Concatenation with tau not materialized - tau [..., 1] shared by the components and broadcasted)
+    """
+    return torch.addcmul(hidden, tau, weight[:, :, -1].view((len(weight),) + (1,) * (hidden.dim() - 2) + (-1,)))
 
 def ones_like(x):
     return torch.ones((x.size(0), x.size(1), 1), requires_grad = True, device = x.get_device() if x.is_cuda else 'cpu')
 
-def sort_given_t(*args, t):
+def length_batches(lengths, batch, pool = 50):
+    """
+        Random batches of patients with similar lengths
+        Shuffled patients are sorted by length within pools of pool * batch
+        and then cut into batches (batch order is shuffled)
+    """
+    order = np.random.permutation(len(lengths))
+    batches = []
+    for start in range(0, len(order), pool * batch):
+        selection = order[start:start + pool * batch]
+        selection = selection[np.argsort(lengths[selection], kind = 'stable')]
+        batches += [selection[j:j + batch] for j in range(0, len(selection), batch)]
+    np.random.shuffle(batches)
+    return batches
+
+def save_checkpoint(path, **state):
+    """
+        Saves the training state (temporary file moved once complete)
+    """
+    temporary = '{}.{}.tmp'.format(path, os.getpid())
+    torch.save(state, temporary)
+    os.replace(temporary, path)
+
+def load_checkpoint(path):
     """
-        Sort any parameter (tensor of same size than t) with regard to t
-        Necessary for DeepSurv that assume all sorted for loss computation
+        Loads the training state saved by save_checkpoint (None if no checkpoint)
     """
-    t, order = torch.sort(t, 0, descending = True) # Wants data to be from unobserved to observed
-    order = order.squeeze()
-    return [arg[order] for arg in args] + [t]
+    if path is None or not os.path.isfile(path):
+        return None
+    return torch.load(path, weights_only = False)
+
+def remove_checkpoint(path):
+    # Training completed
+    if path is not None and os.path.isfile(path):
+        os.remove(path)
+
+class WeightSnapshot():
+    """
+        Copy of the weights of a model in preallocated flat buffers (one by dtype) updated in place
+        time: Time spent copying for this model (total_time: for all models)
+    """
+    total_time = 0.
+
+    def __init__(self, model):
+        self.tensors = list(model.state_dict().values())
+        sizes = {}
+        for tensor in self.tensors:
+            sizes[tensor.dtype] = sizes.get(tensor.dtype, 0) + tensor.numel()
+        self.buffers = {dtype: torch.empty(size, dtype = dtype, device = self.tensors[0].device) for dtype, size in sizes.items()}
+
+        offsets, self.views = dict.fromkeys(sizes, 0), []
+        for tensor in self.tensors:
+            start = offsets[tensor.dtype]
+            self.views.append(self.buffers[tensor.dtype][start:start + tensor.numel()].view_as(tensor))
+            offsets[tensor.dtype] += tensor.numel()
+
+        self.time = 0.
+        self.take()
+
+    @torch.no_grad()
+    def take(self):
+        # Weights of the model => Snapshot
+        start = perf_counter()
+        for view, tensor in zip(self.views, self.tensors):
+            view.copy_(tensor)
+        self._count(perf_counter() - start)
+
+    @torch.no_grad()
+    def restore(self):
+        # Snapshot => Weights of the model
+        start = perf_counter()
+        for view, tensor in zip(self.views, self.tensors):
+            tensor.copy_(view)
+        self._count(perf_counter() - start)
+
+    def state(self):
+        return self.buffers
+
+    @torch.no_grad()
+    def load(self, buffers):
+        for dtype in self.buffers:
+            self.buffers[dtype].copy_(buffers[dtype])
+
+    def _count(self, duration):
+        self.time += duration
+        WeightSnapshot.total_time += duration
+
+def packed(n, shapes, dtype = torch.float64):
+    """
+        Zero tensors [n, *shape] for each shape, all views on one buffer [n, total size]
+        Rows of all of them are then gathered at once (see map_buffers)
+    """
+    sizes = [int(np.prod(shape)) for shape in shapes]
+    buffer = torch.zeros((n, sum(sizes)), dtype = dtype)
+    starts = np.cumsum([0] + sizes)
+    return [buffer[:, start:start + size].view((n,) + tuple(shape)) for start, size, shape in zip(starts, sizes, shapes)]
+
+def buffer_of(tensor):
+    """
+        Buffer of which the tensor is a row view (see packed), the tensor itself otherwise
+    """
+    base = tensor._base
+    if base is not None and base.dim() == 2 and base.is_contiguous() and len(base) == len(tensor) \
+        and tensor.stride(0) == base.stride(0) and 0 <= tensor.storage_offset() - base.storage_offset() < base.stride(0):
+        return base
+    return tensor
+
+def map_buffers(tensors, function):
+    """
+        Applies function once on each buffer of the given tensors (None are kept)
+        function maps rows to rows of a contiguous result (index_select, to, cuda...)
+
+        Returns:
+            List of Tensors: Same views on the results
+    """
+    results, outputs = {}, []
+    for tensor in tensors:
+        if tensor is None:
+            outputs.append(None)
+            continue
+        buffer = buffer_of(tensor)
+        key = (buffer.data_ptr(), buffer.shape, buffer.stride())
+        if key not in results:
+            results[key] = function(buffer)
+        result = results[key]
+        if buffer is tensor:
+            outputs.append(result)
+        else:
+            outputs.append(result.as_strided((len(result),) + tensor.shape[1:], (result.stride(0),) + tensor.stride()[1:],
+                result.storage_offset() + tensor.storage_offset() - buffer.storage_offset()))
+    return outputs
+
+class BatchLoader():
+    """
+        Iterates over batches of the given tensors (None are kept)
+        The next batches are gathered by a background thread while the current one is used
+        Tensors packed in one buffer (see packed) are gathered together (one index_select by buffer)
+    """
+
+    def __init__(self, tensors, prefetch = 2):
+        """
+        Args:
+            tensors (List of Tensors): Tensors with the same first dimension (not copied)
+            prefetch (int): Number of batches gathered in advance (0: gathered when needed - no thread)
+        """
+        self.prefetch = prefetch
+        self.tensors = tensors
+        self.device = next(tensor.device for tensor in tensors if tensor is not None)
+
+    def gather(self, order):
+        """
+            Selects the rows order of all tensors
+        """
+        order = torch.as_tensor(order, dtype = torch.long, device = self.device)
+        return map_buffers(self.tensors, lambda buffer: buffer.index_select(0, order))
+
+    def iterate(self, batches):
+        """
+            Yields the gathered tensors of each (non empty) batch in order
+        """
+        if self.prefetch == 0:
+            for order in batches:
+                if len(order) > 0:
+                    yield self.gather(order)
+            return
+
+        queue, stop = Queue(maxsize = self.prefetch), Event()
+        thread = Thread(target = self._gather_all, args = (batches, queue, stop), daemon = True)
+        thread.start()
+        try:
+            while True:
+                batch = queue.get()
+                if batch is None:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            stop.set()
+            while thread.is_alive():
+                # Unblock the thread waiting on a full queue
+                while not queue.empty():
+                    queue.get()
+                thread.join(timeout = 0.01)
+
+    def _gather_all(self, batches, queue, stop):
+        try:
+            for order in batches:
+                if stop.is_set():
+                    return
+                if len(order) > 0:
+                    queue.put(self.gather(order))
+            queue.put(None)
+        except Exception as error:
+            queue.put(error)
 
 def compute_dwa(previous, previous_2, T = 2):
     """
@@ -77,8 +303,11 @@ def compute_dwa(previous, previous_2, T = 2):
     if 'observational' not in previous_2 or 'observational' not in previous:
         return {}
     else:
-        weights = nn.Softmax(0)((previous['observational'].detach() / (T*previous_2['observational'].detach())))
-        return {'observational': weights}
+        previous, previous_2 = previous['observational'].detach(), previous_2['observational'].detach()
+        # Only the modelled heads are weighted (null loss otherwise): K * softmax over them
+        modelled = previous_2 != 0
+        weights = nn.Softmax(0)(torch.where(modelled, previous / (T * previous_2), -torch.inf))
+        return {'observational': modelled.sum() * weights}
 
 class PositiveLinear(nn.Module):
     """
@@ -109,10 +338,73 @@ class PositiveLinear(nn.Module):
         else:
             return nn.functional.linear(input, self.log_weight ** 2)
 
+class StackedLinear(nn.Module):
+    """
+        Independent linear layers of k components (weights [k, out, in])
+        Input [k, ..., in] - Output [k, ..., out] (See stacked_linear)
+    """
+    def __init__(self, components, in_features, out_features, bias = True):
+        super(StackedLinear, self).__init__()
+        self.components = components
+        self.in_features = in_features
+        self.out_features = out_features
+        self.weight = nn.Parameter(torch.Tensor(components, out_features, in_features))
+        if bias:
+            self.bias = nn.Parameter(torch.Tensor(components, out_features))
+        else:
+            self.register_parameter('bias', None)
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        # Each component as nn.Linear
+        for j in range(self.components):
+            nn.init.kaiming_uniform_(self.weight[j], a = np.sqrt(5))
+            if self.bias is not None:
+                bound = 1 / np.sqrt(self.in_features)
+                nn.init.uniform_(self.bias[j], -bound, bound)
+
+    @property
+    def weights(self):
+        return self.weight
+
+    def forward(self, input):
+        return stacked_linear(input, self.weights, self.bias)
+
+class PositiveStackedLinear(StackedLinear):
+    """
+        Stacked layers with positive weights for monotonic neural networks (See PositiveLinear)
+    """
+    def __init__(self, components, in_features, out_features, bias = False):
+        nn.Module.__init__(self)
+        self.components = components
+        self.in_features = in_features
+        self.out_features = out_features
+        self.log_weight = nn.Parameter(torch.Tensor(components, out_features, in_features))
+        if bias:
+            self.bias = nn.Parameter(torch.Tensor(components, out_features))
+        else:
+            self.register_parameter('bias', None)
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        # Each component as PositiveLinear
+        for j in range(self.components):
+            nn.init.xavier_uniform_(self.log_weight[j])
+            if self.bias is not None:
+                fan_in, _ = nn.init._calculate_fan_in_and_fan_out(self.log_weight[j])
+                bound = np.sqrt(1 / np.sqrt(fan_in))
+                nn.init.uniform_(self.bias[j], -bound, bound)
+        self.log_weight.data.abs_().sqrt_()
+
+    @property
+    def weights(self):
+        return self.log_weight ** 2
+
 class BatchForward(nn.Module):
     """
         Abstract object to simplify batching
     """
+    output_dim = 0 # Dimension of the patients in the outputs (batches concatenated along it)
 
     def forward_batch(self, *args):
         raise NotImplementedError()
@@ -140,7 +432,7 @@ class BatchForward(nn.Module):
                     results[k] = [output]
 
         for k in results:
-            results[k] = torch.cat(results[k], 0)
+            results[k] = torch.cat(results[k], self.output_dim)
 
         return [results[k] for k in results]
 
@@ -149,3 +441,35 @@ class BatchForward(nn.Module):
 
     def predict(self, *args, batch = None, **kwargs):
         return self.batch(self.predict_batch, *args, batch = batch, **kwargs)[0]
+
+class _Method(nn.Module):
+    # Exposes a method of the model as forward (for functional_call)
+    def __init__(self, model, method):
+        super(_Method, self).__init__()
+        self.model = model
+        self.method = method
+
+    def forward(self, *args, **kwargs):
+        return getattr(self.model, self.method)(*args, **kwargs)
+
+class ModelBank():
+    """
+        Models of identical architecture evaluated in lockstep
+        Parameters of the members are stacked and the method is vectorized over them
+        (Gradients flow back to the parameters of each member)
+    """
+
+    def __init__(self, models):
+        self.models = models
+        self.parameters = [dict(model.named_parameters()) for model in models]
+
+    def __call__(self, method, members, *args, **kwargs):
+        """
+            Calls model.method(*args, **kwargs) for each given member (same args)
+
+            Returns:
+                Tensor: Outputs stacked along a first dimension (one per member)
+        """
+        wrapper = _Method(self.models[0], method)
+        parameters = {'model.' + name: torch.stack([self.parameters[k][name] for k in members]) for name in self.parameters[0]}
+        return vmap(lambda p: functional_call(wrapper, p, args, kwargs))(parameters)
@@ -0,0 +1,88 @@
+import pandas as pd
+import numpy as np
+
+def process(data, labels):
+    """
+        Extracts mask and interevents
+        Preprocesses the time of event and event
+        (Patients are sorted once and all per patient operations are segmented numpy operations)
+
+        Args:
+            data (Dataframe): Observations with multi index (Patient, Time)
+            labels (Dataframe): Outcomes (LOS and Death) indexed by Patient
+
+        Returns:
+            Covariates (imputed), interevent times, mask, time to event and event
+    """
+    patients = data.index.get_level_values('Patient')
+    codes, uniques = pd.factorize(patients, sort = True)
+    order = np.argsort(codes, kind = 'stable') # Sorted by patient - Time order conserved
+    lengths = np.bincount(codes)
+    starts = np.repeat(np.cumsum(lengths) - lengths, lengths)
+
+    values = data.to_numpy(dtype = float)[order]
+    codes = codes[order]
+
+    # Forward fill and mean imputation - Patient then population
+    patient_mean = pd.DataFrame(segment_mean(values, lengths), index = pd.Index(uniques, name = 'Patient'), columns = data.columns)
+    pop_mean = patient_mean.mean()
+
+    cov = segment_ffill(values, starts)
+    cov = np.where(np.isnan(cov), patient_mean.values[codes], cov)
+    cov = np.where(np.isnan(cov), pop_mean.values, cov)
+    cov_ordered = np.empty_like(cov)
+    cov_ordered[order] = cov
+    cov = pd.DataFrame(cov_ordered, index = data.index, columns = data.columns)
+
+    # Interevent times (0 for first observation)
+    times = data.index.get_level_values('Time').to_numpy()[order]
+    ie_time = np.zeros(len(times))
+    ie_time[1:] = times[1:] - times[:-1]
+    ie_time[starts == np.arange(len(times))] = 0
+    ie_time = pd.Series(ie_time, index = data.index[order], name = 'Time')
+
+    mask = ~data.isna()
+    time_event = pd.DataFrame((labels.LOS.loc[patients] - data.index.get_level_values(1)).values, index = data.index)
+
+    return cov, ie_time, mask, time_event, labels.Death
+
+def segment_ffill(values, starts):
+    """
+        Forward fill nan values without crossing the start of each segment
+
+        Args:
+            values (Array n * d): Values sorted by segment
+            starts (Array n): Index of the first row of the segment of each row
+    """
+    rows = np.arange(len(values))[:, None]
+    last = np.maximum.accumulate(np.where(np.isnan(values), -1, rows), axis = 0)
+    return np.where(last >= starts[:, None], values[last, np.arange(values.shape[1])], np.nan)
+
+def segment_mean(values, lengths):
+    """
+        Mean of each segment ignoring nan values
+        Summation is compensated (Kahan) in row order as in pandas' groupby mean
+
+        Args:
+            values (Array n * d): Values sorted by segment
+            lengths (Array s): Length of each segment
+    """
+    offsets = np.cumsum(lengths) - lengths
+    total, compensation, count = np.zeros((3, len(lengths), values.shape[1]))
+    for position in range(lengths.max() if len(lengths) else 0):
+        segments = np.nonzero(lengths > position)[0]
+        value = values[offsets[segments] + position]
+        observed = ~np.isnan(value)
+
+        y = value - compensation[segments]
+        t = total[segments] + y
+        c = t - total[segments] - y
+        c[np.isnan(c)] = 0 # Infinite values
+
+        count[segments] += observed
+        compensation[segments] = np.where(observed, c, compensation[segments])
+        total[segments] = np.where(observed, t, total[segments])
+
+    mean = np.full(total.shape, np.nan)
+    np.divide(total, count, out = mean, where = count > 0)
+    return mean